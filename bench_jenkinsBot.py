@@ -0,0 +1,455 @@
+# coding: utf-8
+"""Benchmarks for the JenkinsBot hot paths, run against local stub servers.
+
+Usage: python bench_jenkinsBot.py [benchmark ...] [--requests N]
+                                  [--concurrency N] [--jobs N] [--depth N]
+                                  [--log-size BYTES] [--queue N]
+                                  [--latency MS]
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import perf_counter, sleep
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import requests
+from errbot.backends.test import TestBot
+from jinja2 import Template
+
+import jenkinsBot
+
+GRID = 'bench'
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InstanceAPIHandler(BaseHTTPRequestHandler):
+    """Answer like the instance API of a grid, keeping connections open.
+
+    The server's `latency` attribute is waited before every answer.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        sleep(getattr(self.server, 'latency', 0))
+        address = getattr(self.server, 'address', '10.0.0.1')
+        body = json.dumps({'stdout': [address]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MasterHandler(BaseHTTPRequestHandler):
+    """Answer the Jenkins API calls of the plugin from a generated master.
+
+    The server's `master` attribute holds the generated jobs, queue, build
+    log and the latency injected before every answer.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    JOB = re.compile(r'^/((?:job/[^/]+/)+)(?:(\d+)/)?(.*)$')
+
+    def do_GET(self):
+        master = self.server.master
+        sleep(master['latency'])
+        url = urlsplit(self.path)
+        tree = parse_qs(url.query).get('tree', [''])[0]
+        if url.path == '/api/json':
+            if tree == jenkinsBot.RUNNING_JOBS_TREE:
+                return self.send_json({'jobs': master['running']})
+            return self.send_json(master['tree'])
+        if url.path == '/queue/api/json':
+            return self.send_json({'items': master['queue']})
+        if url.path.startswith('/queue/item/'):
+            return self.send_json({'cancelled': False, 'executable': None})
+        match = self.JOB.match(url.path)
+        if match is None:
+            return self.send_body(404, b'Not found', 'text/plain')
+        number, rest = match.group(2), match.group(3)
+        if number is None and rest == 'api/json':
+            if tree == 'lastBuild[number]':
+                return self.send_json({'lastBuild': {'number': 1}})
+            return self.send_json({'property': [{}]})
+        if number is not None and rest == 'api/json':
+            return self.send_json({'actions': [{
+                'lastBuiltRevision': {'SHA1': '0e51ed0c',
+                                      'branch': [{'name': 'origin/master'}]},
+                'remoteUrls': ['ssh://git@devgit/team_api.git']}]})
+        if number is not None and rest == 'logText/progressiveText':
+            start = int(parse_qs(url.query).get('start', ['0'])[0])
+            log = master['log'][start:]
+            return self.send_body(200, log, 'text/plain', {
+                'X-Text-Size': str(len(master['log']))})
+        return self.send_body(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        master = self.server.master
+        sleep(master['latency'])
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with master['lock']:
+            master['queued'] += 1
+            number = master['queued']
+        self.send_body(201, b'', 'text/plain', {
+            'Location': '/queue/item/{0}/'.format(number)})
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode(), 'application/json')
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def generate_master(args):
+    """Generate the jobs, nested args.depth folders deep, queue and log."""
+    def folder(path, level):
+        if level == args.depth:
+            return [{'name': name, 'fullName': '/'.join(path + [name]),
+                     'url': 'job/{0}/'.format(name), 'color': 'blue'}
+                    for name in leaves['/'.join(path)]]
+        return [{'name': name, 'fullName': '/'.join(path + [name]),
+                 'jobs': folder(path + [name], level + 1)}
+                for name in sorted(children['/'.join(path)])]
+
+    children, leaves, names = {}, {}, []
+    for index in range(args.jobs):
+        path = ['team-{0}'.format((index >> (2 * level)) % 4)
+                for level in range(args.depth)]
+        for level in range(args.depth):
+            children.setdefault('/'.join(path[:level]), set()).add(path[level])
+        leaves.setdefault('/'.join(path), []).append('job-{0}'.format(index))
+        names.append('/'.join(path + ['job-{0}'.format(index)]))
+
+    return {
+        'tree': {'jobs': folder([], 0)},
+        'names': names,
+        'running': [{'name': name, 'color': 'blue_anime' if i % 10 else 'red',
+                     'lastBuild': {'url': 'job/{0}/1/'.format(name), 'number': 1},
+                     'healthReport': [{'description': 'Build stability: ok'}]}
+                    for i, name in enumerate(names[:200])],
+        'queue': [{'id': i, 'why': 'Waiting for next available executor',
+                   'inQueueSince': 0,
+                   'task': {'name': names[i % len(names)], 'url': ''}}
+                  for i in range(args.queue)],
+        'log': b''.join(b'[%08d] Building the bench job, nothing to see here\n'
+                        % i for i in range(args.log_size // 48 + 1))[:args.log_size],
+        'latency': args.latency / 1000,
+        'queued': 0,
+        'lock': threading.Lock(),
+    }
+
+
+def serve(handler):
+    server = StubServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def measure(call, count, concurrency):
+    """Run call() count times on concurrency threads, timing each run."""
+    def timed(_):
+        started = perf_counter()
+        call()
+        return perf_counter() - started
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(count)))
+    elapsed = perf_counter() - started
+    return count / elapsed, latencies
+
+
+def peak_rss():
+    """Return the peak resident set size of the process in MB, if known."""
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def report(name, rate, latencies):
+    print('{0:<32} {1:>10.1f} ops/s  p50 {2:>7.2f} ms  p95 {3:>7.2f} ms  '
+          'p99 {4:>7.2f} ms  peak RSS {5:>6.1f} MB'.format(
+              name, rate, jenkinsBot.percentile(latencies, 50) * 1000,
+              jenkinsBot.percentile(latencies, 95) * 1000,
+              jenkinsBot.percentile(latencies, 99) * 1000, peak_rss()))
+
+
+class Identifier(object):
+    """Stand-in for the room a command is sent from, named after the grid."""
+
+    def __init__(self, channelname):
+        self.channelname = channelname
+        self.person = channelname
+
+    def __str__(self):
+        return '#' + self.channelname
+
+
+class Message(object):
+
+    def __init__(self, channelname):
+        self.frm = Identifier(channelname)
+
+
+@contextmanager
+def bench_plugin(args):
+    """Yield the plugin loaded by a test bot, talking to a stub master.
+
+    Master discovery goes through a stub instance API publishing the
+    stub master. Uploads are read to the end and messages are taken out
+    of the test backend as they are sent, as a chat backend would.
+    """
+    master = generate_master(args)
+    master_server, master_url = serve(MasterHandler)
+    master_server.master = master
+    api_server, api_url = serve(InstanceAPIHandler)
+    api_server.address = master_url[len('http://'):]
+    api_server.latency = master['latency']
+    bot = TestBot(extra_plugin_dir=os.path.dirname(os.path.abspath(__file__)),
+                  loglevel=logging.ERROR,
+                  extra_config={'AUTOINSTALL_DEPS': False})
+    bot.start()
+    running = threading.Event()
+    running.set()
+
+    def consume():
+        while running.is_set():
+            try:
+                bot.pop_message(timeout=0.1)
+            except Empty:
+                pass
+    consumer = threading.Thread(target=consume)
+    consumer.daemon = True
+    consumer.start()
+    plugin = bot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+    plugin.instance_api_url = lambda grid: api_url + '/scripts/jenkins_url'
+
+    def send_stream_request(user, fsource, name=None, size=None,
+                            stream_type=None):
+        while fsource.read(jenkinsBot.CONSOLE_CHUNK_SIZE):
+            pass
+    plugin.send_stream_request = send_stream_request
+    try:
+        yield plugin, master
+    finally:
+        running.clear()
+        consumer.join()
+        bot.stop()
+        master_server.shutdown()
+        api_server.shutdown()
+
+
+def bench_commands(args):
+    """Chat commands answered per second by the plugin against a stub master."""
+    mess = Message(GRID)
+    with bench_plugin(args) as (plugin, master):
+        names = master['names']
+        plugin.connect_to_jenkins(GRID)
+        plugin.job_catalog(GRID)
+
+        def list_cold():
+            plugin.invalidate_catalog(GRID)
+            plugin.jenkins_list(mess, 'job-1')
+
+        for name, command, count in (
+                ('jenkins_list', lambda: plugin.jenkins_list(mess, 'job-1'),
+                 args.requests),
+                ('jenkins_list (catalog refetch)', list_cold,
+                 args.requests // 10),
+                ('jenkins_running', lambda: plugin.jenkins_running(mess, ''),
+                 args.requests),
+                ('jenkins_queue', lambda: plugin.jenkins_queue(mess, 'team-0*'),
+                 args.requests),
+                ('jenkins_build', lambda: plugin.jenkins_build(
+                    mess, [random.choice(names)]), args.requests),
+                ('jenkins_output', lambda: list(plugin.jenkins_output(
+                    mess, [random.choice(names)])), args.requests // 10)):
+            report(name, *measure(command, max(count, 1), args.concurrency))
+        with plugin.tracker.lock:
+            del plugin.tracker.builds[:]
+
+
+def bench_notifications(args):
+    """Jenkins notifications acknowledged, then processed, per second."""
+    with bench_plugin(args) as (plugin, master):
+        names = master['names']
+        plugin.connect_to_jenkins(GRID)
+        base = plugin.config['URL'][GRID]
+        numbers = iter(range(1, sys.maxsize))
+        lock = threading.Lock()
+
+        def notify():
+            with lock:
+                number = next(numbers)
+            name = random.choice(names)
+            plugin.handle_notification({
+                'name': name,
+                'build': {'full_url': '{0}/job/{1}/{2}/'.format(
+                              base, name.replace('/', '/job/'), number),
+                          'number': number, 'phase': 'FINALIZED',
+                          'status': 'SUCCESS'}})
+
+        started = perf_counter()
+        report('handle_notification', *measure(
+            notify, args.requests, args.concurrency))
+        while True:
+            stats = plugin.notifications.snapshot()
+            done = stats['processed'] + stats['failed'] + stats['dropped']
+            if done >= stats['received'] + stats['dropped']:
+                break
+            sleep(0.01)
+        elapsed = perf_counter() - started
+        print('{0:<32} {1:>10.1f} ops/s  ({2} processed, {3} failed, '
+              '{4} dropped)'.format('notification processing',
+                                    args.requests / elapsed, stats['processed'],
+                                    stats['failed'], stats['dropped']))
+
+
+def bench_pool(args):
+    """Instance API lookups with a new connection per call vs a pooled session."""
+    server, base = serve(InstanceAPIHandler)
+    server.latency = args.latency / 1000
+    url = base + '/scripts/jenkins_url'
+    session = jenkinsBot.pooled_session(args.concurrency)
+    try:
+        report('unpooled requests.get', *measure(
+            lambda: jenkinsBot.query_instance_api(url, requests),
+            args.requests, args.concurrency))
+        report('pooled session', *measure(
+            lambda: jenkinsBot.query_instance_api(url, session),
+            args.requests, args.concurrency))
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def notification():
+    return {
+        'name': 'deploy-api',
+        'build': {
+            'full_url': 'https://master-foo.example.com/job/deploy-api/42/',
+            'number': 42,
+            'phase': 'COMPLETED',
+            'status': 'SUCCESS',
+        },
+        'git': {
+            'url': 'https://devgit.cloudpassage.com/team/api',
+            'commit': '0e51ed0c',
+            'branch': 'origin/master',
+        },
+    }
+
+
+def bench_templates(args):
+    """Notifications rendered per second, compiling the template each time vs once."""
+    source = jenkinsBot.DEFAULT_TEMPLATES['notification.txt']
+    for name, render in (
+            ('compiled on every call', lambda: Template(source).render(notification())),
+            ('format_notification', lambda: jenkinsBot.JenkinsBot.format_notification(
+                notification(), False))):
+        report(name, *measure(render, args.requests, 1))
+
+
+def bench_router(args):
+    """Notification URLs routed to their grid, per-request regex vs GridRouter."""
+    domain = 'example.com'
+    grids = ['grid{0}'.format(i) for i in range(50)]
+    corpus = ['https://master-{0}.{1}/job/folder/job/job{2}/{3}/'.format(
+        random.choice(grids), domain, random.randint(0, 500),
+        random.randint(1, 5000)) for _ in range(args.requests)]
+    corpus += ['https://jenkins.other.org/job/x/1/'] * (args.requests // 100)
+    router = jenkinsBot.GridRouter(domain)
+
+    def per_request():
+        for url in corpus:
+            m = re.match(r'https://master-(.*).' + domain, url)
+            m.group(1) if m else None
+
+    def routed():
+        for url in corpus:
+            router.route(url)
+
+    for name, route in (('regex built per request', per_request),
+                        ('GridRouter', routed)):
+        rate, latencies = measure(route, 20, 1)
+        report(name, rate * len(corpus), [
+            latency / len(corpus) for latency in latencies])
+
+
+BENCHMARKS = {
+    'commands': bench_commands,
+    'notifications': bench_notifications,
+    'pool': bench_pool,
+    'router': bench_router,
+    'templates': bench_templates,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--jobs', type=int, default=2000,
+                        help='jobs of the stub master')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='folder levels the jobs are nested in')
+    parser.add_argument('--log-size', type=int, default=1024 * 1024,
+                        help='bytes of console output of a build')
+    parser.add_argument('--queue', type=int, default=100,
+                        help='items in the build queue')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds the stub servers wait before answering')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: ' + ', '.join(sorted(unknown)))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('== {0}: {1}'.format(name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,94 @@ from __future__ import (absolute_import, division,
 from xml.etree import ElementTree as et
 import validators
 import io
+import json
 import re
 import os
+import inspect
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import wait
+from contextlib import contextmanager
+from functools import wraps
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from collections import OrderedDict, deque
 from itertools import chain
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 import requests
+from requests.adapters import HTTPAdapter
 from dns.resolver import query, NXDOMAIN
+try:
+    import yaml
+except ImportError:
+    # Manifests can only be written in JSON without PyYAML
+    yaml = None
 
-from jinja2 import Template
-from jenkins import Jenkins, JenkinsException, LAUNCHER_JNLP
+from jinja2 import (ChoiceLoader, DictLoader, Environment,
+                    FileSystemBytecodeCache, FileSystemLoader)
+from jenkins import (Jenkins, JenkinsException, NotFoundException,
+                     TimeoutException, LAUNCHER_JNLP)
 from errbot import BotPlugin, botcmd, webhook
 from errbot import ValidationException
-from time import sleep
+from flask import Response
+from time import sleep, time
 
 API_TIMEOUT = 5  # Timeout to connect to the AWS metadata service
+DISCOVERY_DEADLINE = 30  # Seconds spent looking for a starting master
+DISCOVERY_WAIT = 3  # Seconds a command waits on discovery before replying
+DISCOVERY_BACKOFF = (0.5, 8)  # Initial and maximum retry delay in seconds
+DISCOVERY_WORKERS = 4  # Instance API requests made at the same time
+BREAKER_THRESHOLD = 3  # Consecutive failed calls after which a grid is cut off
+BREAKER_COOLDOWN = 30  # Seconds a cut off grid is refused before a probe
+FAN_OUT_TIMEOUT = 20  # Seconds a cross-grid command waits for the grids
+FAN_OUT_WORKERS = 16  # Grids queried at the same time by cross-grid commands
+CATALOG_DEPTH = 6  # Folder levels fetched by a single job catalog query
+GIT_CACHE_SIZE = 512  # Builds whose git metadata is kept for later phases
+JOB_PATH = '%(folder_url)sjob/%(short_name)s/'
+BUILD_PATH = JOB_PATH + '%(number)d/'
+CONSOLE_CHUNK_SIZE = 64 * 1024  # Bytes of console output held at once
+TAIL_LINE_BYTES = 160  # Expected line length when seeking back for a tail
+TAIL_DEFAULT_LINES = 50
+FOLLOW_INTERVAL = 10  # Seconds between two posts when following a build
+FOLLOW_TIMEOUT = 15 * 60  # Seconds after which a followed build is let go
+FOLLOW_MAX_CHARS = 4000  # Characters of new output posted at once
+# The only part of a build's info notifications need
+GIT_TREE = 'actions[lastBuiltRevision[SHA1,branch[name]],remoteUrls]'
+# Order of the phases reported by the Jenkins notification plugin
+PHASES = {'QUEUED': 0, 'STARTED': 1, 'COMPLETED': 2, 'FINALIZED': 3}
+DELIVERY_WORKERS = 8  # Chatrooms messages are delivered to at the same time
+METRICS_SAMPLES = 1024  # Latest timings of an operation kept for percentiles
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DIGEST_SIZE = 20  # Pending notifications merged into a single room message
+TRACK_TICK = 1  # Seconds between two runs of the build tracker
+TRACK_INTERVALS = (2, 30)  # Initial and maximum seconds between two checks
+TRACK_TIMEOUT = 6 * 3600  # Seconds after which a build is no longer tracked
+PARAMETERS_CACHE_SIZE = 1024  # Jobs whose parameter definitions are kept
+CONFIG_CACHE_SIZE = 512  # Jobs whose config.xml is kept
+CONFIG_WRITE_AGE = 1  # Seconds a config.xml may be cached for to be rewritten
+# Parameter definitions live in the job properties, or in its actions on
+# older masters
+PARAMETERS_TREE = ','.join(
+    '{0}[parameterDefinitions[name,type,description,choices,'
+    'defaultParameterValue[value]]]'.format(holder)
+    for holder in ('property', 'actions'))
+QUEUE_TREE = 'items[id,why,inQueueSince,task[name,url]]'
+WARM_START_KEY = 'warm_start'  # Plugin storage key of the saved caches
+WARM_START_VERSION = 1  # Bump whenever the layout of the saved caches changes
+WARM_START_MAX_AGE = 24 * 3600  # Seconds after which saved caches are ignored
+QUEUE_IDLE = 10 * 60  # Seconds after which an unused queue stops being polled
+# Everything the node commands display, for every node in a single query
+NODES_TREE = ('computer[displayName,offline,idle,numExecutors,'
+              'assignedLabels[name]]')
+NODES_IDLE = 10 * 60  # Seconds after which an unused inventory stops being polled
+# Everything jenkins_running displays, fetched in a single query
+RUNNING_JOBS_TREE = ('jobs[name,color,lastBuild[url,number],'
+                     'healthReport[description]]')
 
 try:
     from config import JENKINS_URL, JENKINS_USERNAME, JENKINS_PASSWORD
@@ -34,12 +109,106 @@ except ImportError:
     JENKINS_RECEIVE_NOTIFICATION = True
     JENKINS_CHATROOMS_NOTIFICATION = ()
 
+try:
+    from config import JENKINS_CACHE_TTL
+except ImportError:
+    # Seconds a resolved master and its client are reused for a grid
+    JENKINS_CACHE_TTL = 300
+
+try:
+    from config import JENKINS_POOL_SIZE, JENKINS_KEEP_ALIVE
+except ImportError:
+    # Connections kept open per host, shared by all commands of a grid
+    JENKINS_POOL_SIZE = 10
+    JENKINS_KEEP_ALIVE = True
+
+try:
+    from config import JENKINS_CATALOG_REFRESH
+except ImportError:
+    # Seconds between two background refreshes of the job catalogs
+    JENKINS_CATALOG_REFRESH = 300
+
+try:
+    from config import (JENKINS_NOTIFICATION_WORKERS,
+                        JENKINS_NOTIFICATION_QUEUE_SIZE)
+except ImportError:
+    # Threads processing notifications, and notifications waiting for them
+    JENKINS_NOTIFICATION_WORKERS = 4
+    JENKINS_NOTIFICATION_QUEUE_SIZE = 1000
+
+try:
+    from config import JENKINS_NOTIFICATION_WINDOW
+except ImportError:
+    # Seconds during which the phases of a build are merged into one message
+    JENKINS_NOTIFICATION_WINDOW = 2
+
+try:
+    from config import JENKINS_BUILD_CONCURRENCY
+except ImportError:
+    # Builds triggered at the same time by a bulk build command
+    JENKINS_BUILD_CONCURRENCY = 8
+
+try:
+    from config import JENKINS_QUEUE_REFRESH
+except ImportError:
+    # Seconds between two background refreshes of the build queues
+    JENKINS_QUEUE_REFRESH = 10
+
+try:
+    from config import JENKINS_NODE_REFRESH
+except ImportError:
+    # Seconds between two background refreshes of the node inventories
+    JENKINS_NODE_REFRESH = 60
+
+try:
+    from config import JENKINS_TEMPLATE_DIR
+except ImportError:
+    # Directory with templates overriding the default ones, by file name
+    JENKINS_TEMPLATE_DIR = None
+
+try:
+    from config import JENKINS_ROOM_RATE, JENKINS_ROOM_BURST
+except ImportError:
+    # Messages posted per second to a chatroom, and how many can go at once
+    JENKINS_ROOM_RATE = 1
+    JENKINS_ROOM_BURST = 5
+
+try:
+    from config import JENKINS_METRICS_ENDPOINT
+except ImportError:
+    # Serve the metrics in the Prometheus text format on /jenkins/metrics
+    JENKINS_METRICS_ENDPOINT = False
+
 CONFIG_TEMPLATE = {
     'URL': JENKINS_URL,
     'USERNAME': JENKINS_USERNAME,
     'PASSWORD': JENKINS_PASSWORD,
     'RECEIVE_NOTIFICATION': JENKINS_RECEIVE_NOTIFICATION,
-    'CHATROOMS_NOTIFICATION': JENKINS_CHATROOMS_NOTIFICATION}
+    'CHATROOMS_NOTIFICATION': JENKINS_CHATROOMS_NOTIFICATION,
+    'CACHE_TTL': JENKINS_CACHE_TTL,
+    'POOL_SIZE': JENKINS_POOL_SIZE,
+    'KEEP_ALIVE': JENKINS_KEEP_ALIVE,
+    'CATALOG_REFRESH': JENKINS_CATALOG_REFRESH,
+    'NOTIFICATION_WORKERS': JENKINS_NOTIFICATION_WORKERS,
+    'NOTIFICATION_QUEUE_SIZE': JENKINS_NOTIFICATION_QUEUE_SIZE,
+    'NOTIFICATION_WINDOW': JENKINS_NOTIFICATION_WINDOW,
+    'BUILD_CONCURRENCY': JENKINS_BUILD_CONCURRENCY,
+    'QUEUE_REFRESH': JENKINS_QUEUE_REFRESH,
+    'NODE_REFRESH': JENKINS_NODE_REFRESH,
+    'TEMPLATE_DIR': JENKINS_TEMPLATE_DIR,
+    'ROOM_RATE': JENKINS_ROOM_RATE,
+    'ROOM_BURST': JENKINS_ROOM_BURST,
+    'METRICS_ENDPOINT': JENKINS_METRICS_ENDPOINT}
+
+# What the instance API answers once the master of a grid has started
+MASTER_ADDRESS = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+ROUTER_CACHE_SIZE = 4096  # Hosts the grid router remembers
+URL_HOST = re.compile(r'^[a-z][a-z0-9+.-]*://(?:[^@/?#]*@)?([^:/?#]*)',
+                      re.IGNORECASE)
+
+# Errors meaning the cached master of a grid is gone or unreachable
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout,
+                     TimeoutException)
 
 JENKINS_JOB_TEMPLATE_PIPELINE = """<?xml version='1.0' encoding='UTF-8'?>
 <flow-definition plugin="workflow-job">
@@ -133,6 +302,1171 @@ JENKINS_JOB_TEMPLATE_MULTIBRANCH = """<?xml version='1.0' encoding='UTF-8'?>
   </factory>
 </org.jenkinsci.plugins.workflow.multibranch.WorkflowMultiBranchProject>"""
 
+DEFAULT_TEMPLATES = {
+    'params.txt': """{% for p in params %}Type: {{p.type}}
+Description: {{p.description}}
+Default Value: {{p.defaultParameterValue.value}}
+Parameter Name: {{p.name}}
+
+{% endfor %}""",
+    'notification.txt': """Build #{{build.number}} \
+{{build.phase}} {{build.status}} for Job {{fullname}} ({{build.full_url}})
+{% if build.scm %}Based on {{build.scm.url}}/commit/{{build.scm.commit}} \
+({{build.scm.branch}}){% endif %} \
+{% if git %}Based on {{git.url}}/commit/{{git.commit}} \
+({{git.branch}}){% endif %}""",
+}
+
+
+def template_environment(directory=None):
+    """Return a jinja2 environment loading the templates used in replies.
+
+    Templates found in directory override the default ones. Compiled
+    templates are kept in memory and their bytecode on disk, and a
+    template is compiled again only when its file changes.
+    """
+    loaders = [DictLoader(DEFAULT_TEMPLATES)]
+    if directory:
+        loaders.insert(0, FileSystemLoader(directory))
+    return Environment(loader=ChoiceLoader(loaders), auto_reload=True,
+                       bytecode_cache=FileSystemBytecodeCache())
+
+
+TEMPLATES = template_environment()
+
+
+def use_template_directory(directory):
+    """Load the templates from directory, falling back to the defaults."""
+    global TEMPLATES
+    TEMPLATES = template_environment(directory)
+
+
+def render_template(name, context):
+    return TEMPLATES.get_template(name).render(context)
+
+
+class MasterUnavailable(JenkinsException):
+    """The master of a grid cannot be used right now."""
+
+
+class GridDown(MasterUnavailable):
+    """The circuit breaker of a grid is refusing calls."""
+
+
+def pooled_session(pool_size, keep_alive=True):
+    """Return a requests session reusing up to pool_size connections per host."""
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def query_instance_api(url, session=requests, timeout=API_TIMEOUT):
+    """Return the master URL published by an instance API, or None."""
+    resp = session.get(url, timeout=timeout).json()
+    stdout = resp.get('stdout') or ['']
+    if MASTER_ADDRESS.match(stdout[0]) is None:
+        return None
+    return 'http://' + stdout[0]
+
+
+class InvalidParameters(JenkinsException):
+    """Build parameters the job would reject."""
+
+
+class GridRouter(object):
+    """Find the grid a Jenkins URL belongs to from its host.
+
+    Hosts named master-<grid>.<domain> are parsed once with an anchored
+    pattern and remembered, as are the hosts of the masters found through
+    discovery. Unknown hosts route to None.
+    """
+
+    def __init__(self, domain, size=ROUTER_CACHE_SIZE):
+        self.pattern = re.compile(
+            r'^master-(?P<grid>.+)\.' + re.escape(domain) + r'$', re.IGNORECASE)
+        self.size = size
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        match = URL_HOST.match(url)
+        return match.group(1).lower() if match else ''
+
+    def learn(self, url, grid):
+        """Route the host of url, the address of a master, to grid."""
+        with self.lock:
+            self.hosts[self.host(url)] = grid
+
+    def route(self, url):
+        """Return the grid of the master url points to, or None."""
+        host = self.host(url)
+        try:
+            return self.hosts[host]
+        except KeyError:
+            pass
+        match = self.pattern.match(host)
+        grid = match.group('grid') if match else None
+        with self.lock:
+            if len(self.hosts) < self.size:
+                self.hosts[host] = grid
+        return grid
+
+
+class MasterDiscovery(object):
+    """Find the masters of grids through their instance API.
+
+    Concurrent lookups for the same grid share a single in-flight
+    discovery, retried with exponential backoff and full jitter until
+    its deadline. Callers only wait a little while for it, so a master
+    that is still starting does not hold a bot worker for long. Workers
+    only make the requests: retries wait on a timer, so grids whose
+    master is not published yet do not delay the discovery of others.
+    """
+
+    def __init__(self, fetch, deadline=DISCOVERY_DEADLINE,
+                 backoff=DISCOVERY_BACKOFF, workers=DISCOVERY_WORKERS,
+                 done=None):
+        self.fetch = fetch
+        self.done = done
+        self.deadline = deadline
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.inflight = {}
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, grid, wait=DISCOVERY_WAIT):
+        """Return the master URL of a grid, waiting at most `wait` seconds."""
+        with self.lock:
+            future = self.inflight.get(grid)
+            started = future is None
+            if started:
+                future = self.inflight[grid] = Future()
+        if started:
+            future.add_done_callback(lambda f: self.forget(grid, f))
+            self.submit(grid, future, time() + self.deadline, self.backoff[0])
+
+        try:
+            return future.result(timeout=wait)
+        except FutureTimeout:
+            raise MasterUnavailable(
+                'The {0} master is still starting, please try again in a '
+                'moment.'.format(grid))
+
+    def submit(self, grid, future, deadline, delay):
+        try:
+            self.executor.submit(self.attempt, grid, future, deadline, delay)
+        except RuntimeError:  # Shut down
+            future.cancel()
+
+    def attempt(self, grid, future, deadline, delay):
+        """Ask the instance API of a grid for its master once, and retry
+        later if it is not published yet."""
+        try:
+            url = self.fetch(grid)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if url is not None:
+            future.set_result(url)
+            return
+        remaining = deadline - time()
+        if remaining <= 0:
+            future.set_exception(MasterUnavailable(
+                'Could not find the {0} master.'.format(grid)))
+            return
+        self.retries += 1
+        timer = threading.Timer(min(remaining, random.uniform(0, delay)),
+                                self.submit, (grid, future, deadline,
+                                              min(delay * 2, self.backoff[1])))
+        timer.daemon = True
+        timer.start()
+
+    def forget(self, grid, future):
+        with self.lock:
+            if self.inflight.get(grid) is future:
+                del self.inflight[grid]
+        if self.done is not None and not future.cancelled():
+            self.done(grid, future.exception() is None)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class CircuitBreaker(object):
+    """Stop calling a grid that keeps failing.
+
+    The breaker is closed while calls succeed. After threshold
+    consecutive failures it opens, and calls are refused right away for
+    cooldown seconds. It is then half-open: a single call goes through
+    as a probe, closing the breaker if it succeeds and opening it again
+    if it fails. A probe that never reports back is given up on after
+    another cooldown.
+
+    allow() takes the probe, so it must only be called right before a
+    call whose outcome is reported. refusing() tells whether allow()
+    would refuse a call without taking it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, grid=None, threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.grid = grid
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.changed_at = time()
+        self.probe_at = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may go through, as the probe if half-open."""
+        now = time()
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.changed_at >= self.cooldown:
+                self.state, self.changed_at = self.HALF_OPEN, now
+                self.probe_at = None
+            if self.state == self.HALF_OPEN and (
+                    self.probe_at is None or now - self.probe_at >= self.cooldown):
+                self.probe_at = now
+                return True
+            return False
+
+    def refusing(self):
+        """Return whether a call would be refused right now."""
+        now = time()
+        with self.lock:
+            if self.state == self.OPEN:
+                return now - self.changed_at < self.cooldown
+            if self.state == self.HALF_OPEN:
+                return (self.probe_at is not None and
+                        now - self.probe_at < self.cooldown)
+            return False
+
+    def refused(self):
+        """Return the error to raise for a refused call."""
+        return GridDown('The {0} master is unreachable, I will try again '
+                        'in {1:.0f} seconds.'.format(self.grid, self.retry_in()))
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                self.state, self.changed_at = self.CLOSED, time()
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.open()
+
+    def trip(self):
+        """Open the breaker right away."""
+        with self.lock:
+            self.open()
+
+    def open(self):
+        if self.state != self.OPEN:
+            self.trips += 1
+        self.state, self.changed_at = self.OPEN, time()
+
+    def retry_in(self):
+        """Return the seconds left before the next probe."""
+        with self.lock:
+            start = self.probe_at if self.state == self.HALF_OPEN else self.changed_at
+            if self.state == self.CLOSED or start is None:
+                return 0
+            return max(0, self.cooldown - (time() - start))
+
+
+def tree_query(fields, children, depth, leaf=None):
+    """Build a Jenkins tree= query nesting children up to depth levels.
+
+    The deepest level only asks for leaf, when given, instead of fields.
+    """
+    tree = leaf or fields
+    for _ in range(depth - 1):
+        tree = '{0},{1}[{2}]'.format(fields, children, tree)
+    return '{0}[{1}]'.format(children, tree)
+
+
+class JobCatalog(object):
+    """Jobs of a master, indexed by lowercase full name.
+
+    Names are kept sorted for prefix lookups and every name trigram maps
+    to the jobs containing it, so substring searches only check the jobs
+    sharing all the trigrams of the search term.
+    """
+
+    # Jobs nested deeper than CATALOG_DEPTH only have their name fetched,
+    # to tell which folders still need a query of their own
+    TREE = tree_query('name,fullName,url,color', 'jobs', CATALOG_DEPTH + 1,
+                      leaf='name')
+
+    def __init__(self, jobs=()):
+        self.jobs = sorted(jobs, key=lambda job: job['fullname'].lower())
+        self.names = [job['fullname'].lower() for job in self.jobs]
+        self.by_name = dict(zip(self.names, self.jobs))
+        self.trigrams = {}
+        for index, name in enumerate(self.names):
+            for gram in set(name[i:i + 3] for i in range(len(name) - 2)):
+                self.trigrams.setdefault(gram, []).append(index)
+        self.refreshed_at = time()
+        self.stale = False
+
+    @classmethod
+    def from_tree(cls, data):
+        """Build a catalog from a tree= query on the master root."""
+        return cls(cls.flatten(data)[0])
+
+    @staticmethod
+    def flatten(data):
+        """Return the jobs of a TREE query, and the full names of the
+        folders whose jobs were too deep to be part of it."""
+        jobs, folders = [], []
+        pending = [(job, 1) for job in data.get('jobs') or []]
+        while pending:
+            job, depth = pending.pop()
+            fullname = job.get('fullName') or job.get('name')
+            if depth < CATALOG_DEPTH:
+                pending.extend((child, depth + 1)
+                               for child in job.get('jobs') or [])
+            elif job.get('jobs'):
+                folders.append(fullname)
+            jobs.append({'name': job.get('name'),
+                         'fullname': fullname,
+                         'url': job.get('url'),
+                         'color': job.get('color')})
+        return jobs, folders
+
+    def get(self, name):
+        """Return the job named name, ignoring case, or None."""
+        return self.by_name.get(name.lower())
+
+    def prefix(self, term):
+        """Return the jobs whose full name starts with term."""
+        term = term.lower()
+        jobs = []
+        for index in range(bisect_left(self.names, term), len(self.names)):
+            if not self.names[index].startswith(term):
+                break
+            jobs.append(self.jobs[index])
+        return jobs
+
+    def match(self, pattern):
+        """Return the jobs whose full name matches a shell-style pattern."""
+        pattern = pattern.lower()
+        literal = re.split(r'[*?[]', pattern, 1)[0]
+        candidates = self.prefix(literal) if literal else self.jobs
+        return [job for job in candidates
+                if fnmatchcase(job['fullname'].lower(), pattern)]
+
+    def search(self, term):
+        """Return the jobs whose full name contains term, ignoring case."""
+        term = term.lower()
+        if len(term) < 3:
+            return [job for name, job in zip(self.names, self.jobs)
+                    if term in name]
+
+        postings = []
+        for gram in set(term[i:i + 3] for i in range(len(term) - 2)):
+            if gram not in self.trigrams:
+                return []
+            postings.append(self.trigrams[gram])
+        postings.sort(key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [self.jobs[index] for index in sorted(candidates)
+                if term in self.names[index]]
+
+
+class WorkQueue(object):
+    """Bounded queue drained by a pool of worker threads.
+
+    put() never blocks: items arriving while the queue is full are
+    dropped and counted, so producers can always answer right away.
+    """
+
+    STOP = object()
+
+    def __init__(self, handler, log, size):
+        self.handler = handler
+        self.log = log
+        self.queue = Queue(maxsize=size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = {'received': 0, 'processed': 0, 'failed': 0,
+                      'dropped': 0, 'high_watermark': 0}
+
+    def start(self, workers):
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(self.STOP)
+        self.threads = []
+
+    def put(self, item):
+        """Queue item for the workers, returning False if it was dropped."""
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.count('dropped')
+            return False
+        with self.lock:
+            self.stats['received'] += 1
+            self.stats['high_watermark'] = max(self.stats['high_watermark'],
+                                               self.queue.qsize())
+        return True
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is self.STOP:
+                self.queue.task_done()
+                return
+            try:
+                self.handler(item)
+            except Exception:
+                self.count('failed')
+                self.log.exception('Failed to process {0!r}'.format(item))
+            else:
+                self.count('processed')
+            finally:
+                self.queue.task_done()
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def snapshot(self):
+        """Return the counters along with the current queue depth."""
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        stats['size'] = self.queue.maxsize
+        return stats
+
+
+class LRUCache(object):
+    """Thread-safe mapping only keeping its most recently used entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+
+class IterStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def open_console(client, job_name, number, start=0):
+    """Start streaming a build's console output from byte offset start on.
+
+    Jenkins' progressiveText endpoint sends the size of the whole log in
+    X-Text-Size, and X-More-Data while the build is still running.
+    """
+    folder_url, short_name = client._get_job_folder(job_name)
+    url = client._build_url(BUILD_PATH + 'logText/progressiveText', {
+        'folder_url': folder_url, 'short_name': short_name, 'number': number})
+    return client.jenkins_request(
+        requests.Request('GET', url, params={'start': start}),
+        add_crumb=False, stream=True)
+
+
+def iter_console(response, chunk_size=CONSOLE_CHUNK_SIZE):
+    """Yield the body of an open_console response in chunks, then close it."""
+    try:
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
+
+def read_console(client, job_name, number, start=0):
+    """Return the log of a build from byte offset start on.
+
+    Also returns the size of the whole log, which is where the next read
+    should start, and whether the build is still writing to it.
+    """
+    response = open_console(client, job_name, number, start)
+    try:
+        return (response.content,
+                int(response.headers.get('X-Text-Size', 0)),
+                'X-More-Data' in response.headers)
+    finally:
+        response.close()
+
+
+def console_size(client, job_name, number):
+    """Return the size of a build's log without downloading it."""
+    response = open_console(client, job_name, number)
+    response.close()
+    return int(response.headers.get('X-Text-Size', 0))
+
+
+def tail_console(client, job_name, number, count):
+    """Return the last count lines of a build's log.
+
+    Reads start close to the end of the log and move back until enough
+    lines were read, instead of downloading the whole log.
+    """
+    if count < 1:
+        return []
+    size = console_size(client, job_name, number)
+    window = count * TAIL_LINE_BYTES
+    while True:
+        start = max(0, size - window)
+        text = read_console(client, job_name, number, start)[0]
+        lines = text.decode('utf-8', 'replace').splitlines()
+        # Unless the log was read from its start, the first line is partial
+        if start == 0 or len(lines) > count:
+            return lines[-count:]
+        window *= 4
+
+
+def parameter_definitions(job):
+    """Return the parameter definitions of a job, or an empty list."""
+    for holder in (job.get('property') or []) + (job.get('actions') or []):
+        definitions = (holder or {}).get('parameterDefinitions')
+        if definitions:
+            return definitions
+    return []
+
+
+def check_parameters(definitions, params):
+    """Return what is wrong with params given a job's parameter definitions."""
+    known = dict((definition['name'], definition) for definition in definitions)
+    problems = []
+    for name, value in sorted(params.items()):
+        if name == '':
+            continue
+        if name not in known:
+            problems.append('unknown parameter {0}'.format(name))
+        elif known[name].get('choices') and value not in known[name]['choices']:
+            problems.append('{0} should be one of {1}'.format(
+                name, ', '.join(known[name]['choices'])))
+    return problems
+
+
+def repository_name(repository):
+    """Return the name of a git repository from its URL."""
+    name = re.split(r'[/:]', repository.rstrip('/'))[-1]
+    return name[:-len('.git')] if name.endswith('.git') else name
+
+
+def render_job_config(job_type, repository):
+    """Render the config.xml of a pipeline or multibranch job."""
+    if job_type == 'pipeline':
+        return JENKINS_JOB_TEMPLATE_PIPELINE.format(repository=repository)
+    if job_type == 'multibranch':
+        owner = repository.rsplit('/', 2)[-2:][0].split(':')[-1]
+        return JENKINS_JOB_TEMPLATE_MULTIBRANCH.format(
+            repo_owner=owner, repo_name=repository_name(repository))
+    raise ValueError('unknown job type {0}'.format(job_type))
+
+
+def load_manifest(text):
+    """Return the jobs of a JSON or YAML manifest.
+
+    A manifest is a list of jobs, or a mapping with a `jobs` list and a
+    default `type`. A job is a repository URL, or a mapping with a
+    `repository` and optionally a `name` and a `type`.
+    """
+    try:
+        manifest = json.loads(text)
+    except ValueError:
+        if yaml is None:
+            raise ValueError('the manifest is not valid JSON')
+        try:
+            manifest = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError('the manifest is not valid JSON or YAML: '
+                             '{0}'.format(e))
+
+    default_type = 'pipeline'
+    if isinstance(manifest, dict):
+        default_type = manifest.get('type', default_type)
+        manifest = manifest.get('jobs')
+    if not isinstance(manifest, list) or not manifest:
+        raise ValueError('the manifest has no jobs')
+
+    jobs = OrderedDict()
+    for job in manifest:
+        if not isinstance(job, dict):
+            job = {'repository': job}
+        repository = job.get('repository')
+        if not repository or not isinstance(repository, str):
+            raise ValueError('every job needs a repository')
+        name = job.get('name') or repository_name(repository)
+        if name in jobs:
+            raise ValueError('{0} is in the manifest twice'.format(name))
+        jobs[name] = {'name': name, 'repository': repository,
+                      'type': job.get('type', default_type)}
+    return list(jobs.values())
+
+
+def same_config(current, wanted):
+    """Tell whether two config.xml documents describe the same job,
+    ignoring whitespace and the plugin versions Jenkins adds."""
+    def canonical(element):
+        attributes = dict((name, value) for name, value in element.attrib.items()
+                          if name != 'plugin')
+        return (element.tag, attributes, (element.text or '').strip(),
+                [canonical(child) for child in element])
+
+    try:
+        return canonical(et.fromstring(current)) == canonical(et.fromstring(wanted))
+    except et.ParseError:
+        return False
+
+
+def set_git_branch(job_xml, branch):
+    """Return job_xml set to build branch, or None if it already does.
+
+    Raises ValueError when the job has no git branch to set.
+    """
+    tree = et.fromstring(job_xml)
+    spec = tree.find('.//hudson.plugins.git.BranchSpec/name')
+    if spec is None:
+        raise ValueError('no git branch to set')
+    if spec.text == branch:
+        return None
+    spec.text = branch
+    return et.tostring(tree, encoding='utf-8').decode('utf-8')
+
+
+def git_metadata(actions):
+    """Return the commit, branch and devgit URL found in a build's actions."""
+    for action in actions:
+        revision = (action or {}).get('lastBuiltRevision')
+        if revision is None:
+            continue
+        remote_url = action['remoteUrls'][0]
+        return {
+            'commit': revision['SHA1'],
+            'branch': revision['branch'][0]['name'],
+            'url': 'https://devgit.cloudpassage.com/' +
+                   remote_url[remote_url.find('devgit') + 7:].replace('_', '/'),
+        }
+    return {}
+
+
+class NotificationCoalescer(object):
+    """Merge the notifications Jenkins sends for a build in a short window.
+
+    The first notification of a build opens a window. Notifications of
+    the same build arriving before it closes replace the pending one when
+    they report a later phase, and only the latest one is flushed.
+    FINALIZED is the last phase of a build, so it is flushed right away.
+    """
+
+    def __init__(self, flush, window):
+        self.flush = flush
+        self.window = window
+        self.pending = {}
+        self.merged = 0
+        self.lock = threading.Lock()
+
+    def add(self, key, notification):
+        phase = PHASES.get(notification['build'].get('phase'), -1)
+        with self.lock:
+            current = self.pending.pop(key, None)
+            if current is not None:
+                self.merged += 1
+                if phase < PHASES.get(current['build'].get('phase'), -1):
+                    notification = current
+            if phase != PHASES['FINALIZED']:
+                if current is None:
+                    timer = threading.Timer(self.window, self.expire, (key,))
+                    timer.daemon = True
+                    timer.start()
+                self.pending[key] = notification
+                return
+        self.flush(notification)
+
+    def expire(self, key):
+        with self.lock:
+            notification = self.pending.pop(key, None)
+        if notification is not None:
+            self.flush(notification)
+
+    def flush_all(self):
+        with self.lock:
+            keys = list(self.pending)
+        for key in keys:
+            self.expire(key)
+
+
+class TokenBucket(object):
+    """Allow rate events per second, and bursts of up to capacity events."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+
+    def take(self):
+        """Take a token, or return the seconds to wait before one is there."""
+        now = time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Outbox(object):
+    """Deliver messages to chatrooms, rate limited per room.
+
+    Each room has its own token bucket and pending messages, drained by
+    at most one task of executor at a time so that rooms are served
+    concurrently. Messages piling up while a room waits for a token are
+    handed to deliver together, up to batch_size at once.
+    """
+
+    def __init__(self, deliver, executor, log, rate, burst,
+                 batch_size=DIGEST_SIZE):
+        self.deliver = deliver
+        self.executor = executor
+        self.log = log
+        self.rate = rate
+        self.burst = burst
+        self.batch_size = batch_size
+        self.rooms = {}
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def put(self, room, message):
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None:
+                state = self.rooms[room] = {
+                    'bucket': TokenBucket(self.rate, self.burst),
+                    'pending': deque(),
+                    'draining': False}
+            state['pending'].append(message)
+            if state['draining']:
+                return
+            state['draining'] = True
+        self.executor.submit(self.drain, room)
+
+    def drain(self, room):
+        state = self.rooms[room]
+        while True:
+            with self.lock:
+                if not state['pending']:
+                    state['draining'] = False
+                    return
+            delay = state['bucket'].take()
+            if delay:
+                sleep(delay)
+                continue
+            with self.lock:
+                pending = state['pending']
+                batch = [pending.popleft()
+                         for _ in range(min(self.batch_size, len(pending)))]
+            try:
+                self.deliver(room, batch)
+                self.sent += 1
+            except Exception as e:
+                self.log.exception('Delivery to %s failed: %s', room, e)
+
+    def count(self):
+        with self.lock:
+            return sum(len(state['pending'])
+                       for state in self.rooms.values())
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Metrics(object):
+    """Latencies and error counts of the plugin's operations.
+
+    Every operation keeps its call count, total time and its latest
+    METRICS_SAMPLES timings, from which percentiles are computed.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.samples = samples
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, failed=False):
+        with self.lock:
+            operation = self.operations.get(name)
+            if operation is None:
+                operation = self.operations[name] = {
+                    'count': 0, 'errors': 0, 'sum': 0.0,
+                    'samples': deque(maxlen=self.samples)}
+            operation['count'] += 1
+            operation['errors'] += failed
+            operation['sum'] += seconds
+            operation['samples'].append(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        started = time()
+        try:
+            yield
+        except Exception:
+            self.observe(name, time() - started, True)
+            raise
+        self.observe(name, time() - started)
+
+    def snapshot(self):
+        """Return the count, errors, sum and percentiles of each operation."""
+        with self.lock:
+            operations = [(name, dict(operation,
+                                      samples=list(operation['samples'])))
+                          for name, operation in self.operations.items()]
+        stats = OrderedDict()
+        for name, operation in sorted(operations):
+            samples = operation.pop('samples')
+            for p in self.PERCENTILES:
+                operation['p{0}'.format(p)] = percentile(samples, p)
+            stats[name] = operation
+        return stats
+
+    def prometheus(self, counters=(), gauges=()):
+        """Render the operations, counters and gauges in the text format."""
+        lines = ['# TYPE jenkinsbot_operation_seconds summary']
+        errors = ['# TYPE jenkinsbot_operation_errors_total counter']
+        for name, operation in self.snapshot().items():
+            label = 'operation="{0}"'.format(name)
+            for p in self.PERCENTILES:
+                lines.append('jenkinsbot_operation_seconds{{{0},quantile="{1}"}} '
+                             '{2!r}'.format(label, p / 100,
+                                            operation['p{0}'.format(p)]))
+            lines.append('jenkinsbot_operation_seconds_sum{{{0}}} {1!r}'.format(
+                label, operation['sum']))
+            lines.append('jenkinsbot_operation_seconds_count{{{0}}} {1}'.format(
+                label, operation['count']))
+            errors.append('jenkinsbot_operation_errors_total{{{0}}} {1}'.format(
+                label, operation['errors']))
+        lines.extend(errors)
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for name, value in sorted(dict(values).items()):
+                metric = 'jenkinsbot_' + name.replace('.', '_')
+                if kind == 'counter':
+                    metric += '_total'
+                lines.append('# TYPE {0} {1}'.format(metric, kind))
+                lines.append('{0} {1}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+def master_failed(error):
+    """Return whether an error means the master could not answer.
+
+    python-jenkins raises most HTTP errors as a JenkinsException, so the
+    exceptions it was raised from are looked at as well.
+    """
+    while error is not None:
+        if isinstance(error, CONNECTION_ERRORS):
+            return True
+        if isinstance(error, requests.HTTPError):
+            return (error.response is not None and
+                    error.response.status_code >= 500)
+        error = (getattr(error, '__cause__', None) or
+                 getattr(error, '__context__', None))
+    return False
+
+
+class InstrumentedJenkins(object):
+    """Time every public call made through a python-jenkins client.
+
+    Calls are also subject to the grid's circuit breaker, if any, and
+    report to it: a master that answers, even with an error, is a
+    success unless the error is a 5xx. Private attributes such as
+    _session and _build_url are handed out untouched.
+    """
+
+    def __init__(self, client, metrics, breaker=None):
+        self.client = client
+        self.metrics = metrics
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def timed(*args, **kwargs):
+            if self.breaker is not None and not self.breaker.allow():
+                raise self.breaker.refused()
+            try:
+                with self.metrics.timed('jenkins.' + name):
+                    result = attribute(*args, **kwargs)
+            except CONNECTION_ERRORS + (JenkinsException, requests.HTTPError) as e:
+                self.report(not master_failed(e))
+                raise
+            self.report(True)
+            return result
+        return timed
+
+    def report(self, answered):
+        if self.breaker is not None:
+            if answered:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+
+class QueueSnapshot(object):
+    """Items of a master's build queue, indexed by id and by task name."""
+
+    def __init__(self, items=()):
+        self.items = sorted(items, key=lambda item: item.get('inQueueSince', 0))
+        self.by_id = dict((item['id'], item) for item in self.items)
+        self.by_name = {}
+        for item in self.items:
+            self.by_name.setdefault(item['task']['name'].lower(), []).append(item)
+        self.taken_at = time()
+        self.used_at = self.taken_at
+
+    @classmethod
+    def from_tree(cls, data):
+        """Build a snapshot from a tree= query on the master queue."""
+        return cls(data.get('items') or [])
+
+    def find(self, pattern):
+        """Return the items whose task name is pattern, or matches it when it
+        is a shell-style pattern, ignoring case."""
+        pattern = pattern.lower()
+        if not re.search(r'[*?[]', pattern):
+            return list(self.by_name.get(pattern, []))
+        return [item for item in self.items
+                if fnmatchcase(item['task']['name'].lower(), pattern)]
+
+    def without(self, ids):
+        """Return a copy of the snapshot without the given item ids."""
+        snapshot = QueueSnapshot(item for item in self.items
+                                 if item['id'] not in ids)
+        snapshot.taken_at = self.taken_at
+        return snapshot
+
+
+class NodeInventory(object):
+    """Nodes of a master, indexed by lowercase name.
+
+    Node commands update the inventory in place, so it stays accurate
+    between two refreshes.
+    """
+
+    def __init__(self, nodes=()):
+        self.nodes = dict((node['name'].lower(), node) for node in nodes)
+        self.refreshed_at = time()
+        self.used_at = self.refreshed_at
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_tree(cls, data):
+        """Build an inventory from a tree= query on the master computers."""
+        nodes = []
+        for computer in data.get('computer') or []:
+            name = computer.get('displayName')
+            nodes.append({
+                'name': name,
+                'offline': computer.get('offline', True),
+                'idle': computer.get('idle', True),
+                'executors': computer.get('numExecutors') or 0,
+                'labels': sorted(label['name'] for label in
+                                 computer.get('assignedLabels') or []
+                                 if label.get('name') != name)})
+        return cls(nodes)
+
+    def find(self, term=''):
+        """Return the nodes having label term, else the nodes whose name
+        matches term as a shell-style pattern, ignoring case."""
+        with self.lock:
+            nodes = sorted(self.nodes.values(),
+                           key=lambda node: node['name'].lower())
+        if not term:
+            return nodes
+        term = term.lower()
+        labelled = [node for node in nodes
+                    if term in [label.lower() for label in node['labels']]]
+        return labelled or [node for node in nodes
+                            if fnmatchcase(node['name'].lower(), term)]
+
+    def put(self, node):
+        with self.lock:
+            self.nodes[node['name'].lower()] = node
+
+    def remove(self, name):
+        with self.lock:
+            self.nodes.pop(name.lower(), None)
+
+    def update(self, name, **changes):
+        with self.lock:
+            node = self.nodes.get(name.lower())
+            if node is not None:
+                self.nodes[name.lower()] = dict(node, **changes)
+
+    def expire(self):
+        """Have the next lookup fetch the nodes again, for changes whose
+        outcome only the master knows."""
+        self.refreshed_at = 0
+
+    def executors(self):
+        """Return the nodes and executors of every label, and of all nodes
+        under None."""
+        summary = OrderedDict()
+        for node in self.find():
+            for label in [None] + node['labels']:
+                counts = summary.setdefault(label, {
+                    'nodes': 0, 'executors': 0, 'online': 0, 'idle': 0})
+                counts['nodes'] += 1
+                counts['executors'] += node['executors']
+                if not node['offline']:
+                    counts['online'] += node['executors']
+                    if node['idle']:
+                        counts['idle'] += node['executors']
+        return summary
+
+
+class BuildTracker(object):
+    """Follow queued builds until they are over, from a single poller.
+
+    Each build is checked again after an interval growing from the first
+    to the second TRACK_INTERVALS, so short builds are reported quickly
+    while long ones only cost a few requests. check(build) returns True
+    once there is nothing left to follow.
+    """
+
+    def __init__(self, check, log, intervals=TRACK_INTERVALS,
+                 timeout=TRACK_TIMEOUT):
+        self.check = check
+        self.log = log
+        self.intervals = intervals
+        self.timeout = timeout
+        self.builds = []
+        self.lock = threading.Lock()
+
+    def track(self, build):
+        now = time()
+        build.update(added=now, interval=self.intervals[0],
+                     next_check=now + self.intervals[0])
+        with self.lock:
+            self.builds.append(build)
+
+    def poll(self):
+        now = time()
+        with self.lock:
+            due = [build for build in self.builds if build['next_check'] <= now]
+        for build in due:
+            try:
+                done = self.check(build)
+            except Exception as e:
+                self.log.warning('Failed to check build {0!r}: {1}'.format(build, e))
+                done = False
+            if not done and now - build['added'] > self.timeout:
+                self.log.info('Giving up on build {0!r}'.format(build))
+                done = True
+            if done:
+                with self.lock:
+                    self.builds.remove(build)
+            else:
+                build['interval'] = min(build['interval'] * 1.5,
+                                        self.intervals[1])
+                build['next_check'] = now + build['interval']
+
+
+def grid_command(func):
+    """Handle an unusable master for commands scoped to a grid.
+
+    Users get an immediate reply while a master is being discovered, and
+    the cached master of the message's grid is forgotten when it fails
+    us, so the next command resolves it again instead of reusing a
+    client pointing to a dead instance.
+    """
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def generator_wrapper(self, mess, args):
+            try:
+                for reply in func(self, mess, args):
+                    yield reply
+            except MasterUnavailable as e:
+                yield str(e)
+            except CONNECTION_ERRORS:
+                self.invalidate_jenkins(mess.frm.channelname)
+                raise
+        return generator_wrapper
+
+    @wraps(func)
+    def wrapper(self, mess, args):
+        try:
+            return func(self, mess, args)
+        except MasterUnavailable as e:
+            return str(e)
+        except CONNECTION_ERRORS:
+            self.invalidate_jenkins(mess.frm.channelname)
+            raise
+    return wrapper
+
 
 class JenkinsBot(BotPlugin):
     """Basic Err integration with Jenkins CI"""
@@ -148,10 +1482,63 @@ class JenkinsBot(BotPlugin):
                                 configuration.items()))
         else:
             config = CONFIG_TEMPLATE
+        use_template_directory(config['TEMPLATE_DIR'])
         self.jenkins = {}
+        self.jenkins_connected = {}
+        self.jenkins_lock = threading.Lock()
+        self.sessions = {}
+        self.router = GridRouter(os.environ.get('DOMAIN', ''))
+        self.catalogs = {}
+        self.parameters = LRUCache(PARAMETERS_CACHE_SIZE)
+        self.configs = LRUCache(CONFIG_CACHE_SIZE)
+        self.queues = {}
+        self.inventories = {}
+        self.breakers = {}
+        if getattr(self, 'discovery', None) is not None:
+            self.discovery.shutdown()
+        self.discovery = MasterDiscovery(self.fetch_jenkins_url,
+                                         done=self.discovery_done)
         super(JenkinsBot, self).configure(config)
         return
 
+    def activate(self):
+        super(JenkinsBot, self).activate()
+        self.notifications = WorkQueue(self.process_notification, self.log,
+                                       self.config['NOTIFICATION_QUEUE_SIZE'])
+        self.notifications.start(self.config['NOTIFICATION_WORKERS'])
+        self.coalescer = NotificationCoalescer(
+            self.queue_notification, self.config['NOTIFICATION_WINDOW'])
+        self.git_metadata = LRUCache(GIT_CACHE_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS)
+        self.tracker = BuildTracker(self.check_build, self.log)
+        self.followers = BuildTracker(
+            self.follow_build, self.log,
+            intervals=(FOLLOW_INTERVAL, FOLLOW_INTERVAL), timeout=FOLLOW_TIMEOUT)
+        self.metrics = Metrics()
+        self.identifiers = {}
+        self.delivery = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS)
+        self.outbox = Outbox(self.deliver, self.delivery, self.log,
+                             self.config['ROOM_RATE'],
+                             self.config['ROOM_BURST'])
+        self.start_poller(self.config['CATALOG_REFRESH'], self.refresh_catalogs)
+        self.start_poller(TRACK_TICK, self.tracker.poll)
+        self.start_poller(TRACK_TICK, self.followers.poll)
+        self.start_poller(self.config['QUEUE_REFRESH'], self.refresh_queues)
+        self.start_poller(self.config['NODE_REFRESH'], self.refresh_inventories)
+        self.load_warm_start()
+        self.start_poller(self.config['CATALOG_REFRESH'], self.save_warm_start)
+
+    def deactivate(self):
+        self.save_warm_start()
+        self.coalescer.flush_all()
+        self.notifications.stop()
+        self.executor.shutdown(wait=False)
+        self.delivery.shutdown(wait=False)
+        self.discovery.shutdown()
+        for session in self.sessions.values():
+            session.close()
+        super(JenkinsBot, self).deactivate()
+
     def check_configuration(self, configuration):
         self.log.debug(configuration)
         for c, v in configuration.items():
@@ -167,57 +1554,373 @@ class JenkinsBot(BotPlugin):
         return
 
     def connect_to_jenkins(self, grid):
-        self.set_jenkins_url(grid)
-        """Connect to a Jenkins instance using configuration."""
+        """Connect to a Jenkins instance using configuration.
+
+        The resolved master and its client are reused for CACHE_TTL
+        seconds, or until invalidate_jenkins is called for the grid.
+        """
+        breaker = self.breaker(grid)
+        if breaker.refusing():
+            raise breaker.refused()
+        with self.jenkins_lock:
+            connected_at = self.jenkins_connected.get(grid)
+            if (connected_at is not None and
+                    time() - connected_at < self.config['CACHE_TTL']):
+                return
+
+        with self.metrics.timed('connect_to_jenkins'):
+            self.set_jenkins_url(grid)
+            self.open_client(grid)
+        return
+
+    def open_client(self, grid):
+        """Create the client of a grid for its current master URL."""
         self.log.debug('Connecting to Jenkins ({0})'.format(
                         self.config['URL'][grid]))
-        self.jenkins[grid] = Jenkins(url=self.config['URL'][grid],
-                                    username=self.config['USERNAME'],
-                                    password=self.config['PASSWORD'])
+        self.router.learn(self.config['URL'][grid], grid)
+        client = Jenkins(url=self.config['URL'][grid],
+                         username=self.config['USERNAME'],
+                         password=self.config['PASSWORD'])
+        session = self.session_for(grid)
+        for prefix, adapter in session.adapters.items():
+            client._session.mount(prefix, adapter)
+        if not self.config['KEEP_ALIVE']:
+            client._session.headers['Connection'] = 'close'
+        client = InstrumentedJenkins(client, self.metrics, self.breaker(grid))
+        with self.jenkins_lock:
+            self.jenkins[grid] = client
+            self.jenkins_connected[grid] = time()
+
+    def breaker(self, grid):
+        """Return the circuit breaker of a grid."""
+        with self.jenkins_lock:
+            if grid not in self.breakers:
+                self.breakers[grid] = CircuitBreaker(grid)
+            return self.breakers[grid]
+
+    def discovery_done(self, grid, found):
+        """Cut a grid off once a whole discovery failed to find its master.
+
+        Finding it says nothing about the master's API, so only the calls
+        made to it close the breaker again.
+        """
+        if not found:
+            self.breaker(grid).trip()
+
+    def session_for(self, grid):
+        """Return the pooled HTTP session shared by all traffic of a grid."""
+        with self.jenkins_lock:
+            if grid not in self.sessions:
+                self.sessions[grid] = pooled_session(
+                    self.config['POOL_SIZE'], self.config['KEEP_ALIVE'])
+            return self.sessions[grid]
+
+    def invalidate_jenkins(self, grid):
+        """Drop the cached master and client of a grid."""
+        self.log.debug('Invalidating Jenkins client for {0}'.format(grid))
+        with self.jenkins_lock:
+            self.jenkins_connected.pop(grid, None)
         return
 
-    def broadcast(self, mess, use_card):
+    def broadcast(self, mess, use_card, rooms=()):
         """Shortcut to broadcast a message to all elligible chatrooms."""
         chatrooms = (self.config['CHATROOMS_NOTIFICATION']
-                     or self.config['GRID_NOTIFICATION']
+                     or rooms
                      or self.bot_config.CHATROOM_PRESENCE)
 
-        for room in chatrooms:
+        with self.metrics.timed('broadcast'):
+            for room in chatrooms:
+                self.outbox.put(room, (mess, use_card))
+        return
+
+    def identifier(self, room):
+        """Return the identifier of a chatroom, built once per room."""
+        identifier = self.identifiers.get(room)
+        if identifier is None:
+            identifier = self.identifiers[room] = self.build_identifier(room)
+        return identifier
+
+    def deliver(self, room, messages):
+        """Post messages to a chatroom, as a single digest when several."""
+        with self.metrics.timed('chat.deliver'):
+            to = self.identifier(room)
+            if len(messages) > 1:
+                self.send(to, self.format_digest(messages))
+                return
+            mess, use_card = messages[0]
             if use_card:
-                mess['to'] = self.build_identifier(room)
-                self.send_card(**mess)
+                self.send_card(to=to, **mess)
             else:
-                self.send(self.build_identifier(room), mess)
-        return
+                self.send(to, mess)
+
+    def fan_out(self, func):
+        """Run func(grid) on every configured grid concurrently.
+
+        Grids failing or not answering within FAN_OUT_TIMEOUT seconds get
+        an error line, so a single slow master does not hide the others.
+        """
+        grids = sorted(self.config['URL'])
+        futures = [self.executor.submit(self.run_on_grid, func, grid)
+                   for grid in grids]
+        wait(futures, timeout=FAN_OUT_TIMEOUT)
+
+        replies = []
+        for grid, future in zip(grids, futures):
+            if not future.done():
+                reply = 'No answer after {0} seconds.'.format(FAN_OUT_TIMEOUT)
+            elif future.exception() is not None:
+                reply = 'Oops, {0}'.format(future.exception())
+            else:
+                reply = future.result()
+            replies.append('[{0}]\n{1}'.format(grid, reply))
+        return '\n\n'.join(replies) or 'No grids configured.'
+
+    def run_on_grid(self, func, grid):
+        """Connect to a grid, then return func(grid)."""
+        try:
+            self.connect_to_jenkins(grid)
+            return func(grid)
+        except MasterUnavailable as e:
+            return str(e)
+        except CONNECTION_ERRORS:
+            self.invalidate_jenkins(grid)
+            raise
+
+    def jenkins_tree(self, grid, path, tree, **variables):
+        """Fetch path/api/json from a grid's master, limited to a tree= query."""
+        client = self.jenkins[grid]
+        return json.loads(client.jenkins_open(requests.Request(
+            'GET', client._build_url(path + 'api/json', variables),
+            params={'tree': tree})))
+
+    def job_catalog(self, grid):
+        """Return the job catalog of a grid, fetching it when missing or stale."""
+        with self.jenkins_lock:
+            catalog = self.catalogs.get(grid)
+        if catalog is None or catalog.stale:
+            catalog = self.refresh_catalog(grid)
+        return catalog
+
+    def refresh_catalog(self, grid):
+        """Fetch every job of a grid in a single tree= query, plus one per
+        folder nested deeper than CATALOG_DEPTH."""
+        self.log.debug('Refreshing job catalog of {0}'.format(grid))
+        jobs, folders = JobCatalog.flatten(
+            self.jenkins_tree(grid, '', JobCatalog.TREE))
+        while folders:
+            folder_url, short_name = self.jenkins[grid]._get_job_folder(
+                folders.pop())
+            deeper_jobs, deeper_folders = JobCatalog.flatten(self.jenkins_tree(
+                grid, JOB_PATH, JobCatalog.TREE,
+                folder_url=folder_url, short_name=short_name))
+            jobs.extend(deeper_jobs)
+            folders.extend(deeper_folders)
+        catalog = JobCatalog(jobs)
+        with self.jenkins_lock:
+            self.catalogs[grid] = catalog
+        return catalog
+
+    def refresh_catalogs(self):
+        """Keep the catalogs of every grid already used up to date."""
+        with self.jenkins_lock:
+            grids = list(self.catalogs)
+        self.refresh_grids(grids, self.refresh_catalog, 'job catalog')
+
+    def refresh_grids(self, grids, refresh, what):
+        """Call refresh(grid) for each grid from a poller, logging failures
+        rather than raising them."""
+        for grid in grids:
+            try:
+                self.connect_to_jenkins(grid)
+                refresh(grid)
+            except MasterUnavailable as e:
+                self.log.info('Not refreshing {0}: {1}'.format(what, e))
+            except CONNECTION_ERRORS + (JenkinsException,) as e:
+                self.invalidate_jenkins(grid)
+                self.log.warning('Failed to refresh {0} of {1}: {2}'.format(
+                    what, grid, e))
+
+    def save_warm_start(self):
+        """Save the masters, job catalogs and parameter definitions of the
+        grids in use, so that a restarted bot does not start cold."""
+        now = time()
+        with self.jenkins_lock:
+            grids = dict((grid, {'url': self.config['URL'].get(grid),
+                                 'saved_at': now, 'catalog': [],
+                                 'parameters': {}})
+                         for grid in self.jenkins_connected)
+            for grid, catalog in self.catalogs.items():
+                if grid in grids:
+                    grids[grid]['catalog'] = catalog.jobs
+        for (grid, job_name), (_, definitions) in self.parameters.items():
+            if grid in grids:
+                grids[grid]['parameters'][job_name] = definitions
+        self[WARM_START_KEY] = {
+            'version': WARM_START_VERSION,
+            'grids': dict((grid, cache) for grid, cache in grids.items()
+                          if cache['url'])}
+
+    def load_warm_start(self):
+        """Restore the caches saved by save_warm_start.
+
+        Restored grids are used right away, and revalidated in the
+        background.
+        """
+        try:
+            saved = self[WARM_START_KEY]
+        except KeyError:
+            return
+        if saved.get('version') != WARM_START_VERSION:
+            self.log.info('Ignoring caches saved by another version')
+            return
+
+        for grid, cache in saved['grids'].items():
+            if time() - cache['saved_at'] > WARM_START_MAX_AGE:
+                continue
+            self.config['URL'][grid] = cache['url']
+            self.open_client(grid)
+            if cache['catalog']:
+                catalog = JobCatalog(cache['catalog'])
+                catalog.refreshed_at = cache['saved_at']
+                with self.jenkins_lock:
+                    self.catalogs[grid] = catalog
+            # Definitions keep their age, not to outlive CACHE_TTL
+            for job_name, definitions in cache['parameters'].items():
+                self.parameters.put((grid, job_name),
+                                    (cache['saved_at'], definitions))
+            self.executor.submit(self.revalidate_grid, grid, cache['url'],
+                                 list(cache['parameters']))
+
+    def revalidate_grid(self, grid, url, job_names):
+        """Check that a restored grid still has the same master, then
+        refetch its catalog and the parameter definitions of job_names."""
+        try:
+            if self.discovery.resolve(grid, wait=DISCOVERY_DEADLINE) != url:
+                self.invalidate_jenkins(grid)
+            self.connect_to_jenkins(grid)
+            self.refresh_catalog(grid)
+            for job_name in job_names:
+                try:
+                    self.refresh_parameters(grid, job_name)
+                except NotFoundException:
+                    self.invalidate_parameters(grid, job_name)
+        except MasterUnavailable as e:
+            self.invalidate_jenkins(grid)
+            self.log.info('Not revalidating {0}: {1}'.format(grid, e))
+        except CONNECTION_ERRORS + (JenkinsException,) as e:
+            self.invalidate_jenkins(grid)
+            self.log.warning('Failed to revalidate {0}: {1}'.format(grid, e))
+
+    def invalidate_catalog(self, grid):
+        """Refetch the job catalog of a grid on its next use."""
+        with self.jenkins_lock:
+            catalog = self.catalogs.get(grid)
+            if catalog is not None:
+                catalog.stale = True
+
+    def queue_snapshot(self, grid):
+        """Return the build queue of a grid, fetching it when missing or old.
+
+        Using a snapshot keeps the grid's queue refreshed in the background
+        until it has not been used for QUEUE_IDLE seconds.
+        """
+        with self.jenkins_lock:
+            snapshot = self.queues.get(grid)
+        if (snapshot is None or
+                time() - snapshot.taken_at > 2 * self.config['QUEUE_REFRESH']):
+            snapshot = self.refresh_queue(grid)
+        snapshot.used_at = time()
+        return snapshot
+
+    def refresh_queue(self, grid):
+        """Fetch the build queue of a grid in a single tree= query."""
+        snapshot = QueueSnapshot.from_tree(
+            self.jenkins_tree(grid, 'queue/', QUEUE_TREE))
+        with self.jenkins_lock:
+            previous = self.queues.get(grid)
+            if previous is not None:
+                snapshot.used_at = previous.used_at
+            self.queues[grid] = snapshot
+        return snapshot
+
+    def refresh_queues(self):
+        """Keep the queues of the grids recently looked at up to date."""
+        with self.jenkins_lock:
+            grids = [grid for grid, snapshot in self.queues.items()
+                     if time() - snapshot.used_at < QUEUE_IDLE]
+        self.refresh_grids(grids, self.refresh_queue, 'build queue')
+
+    def node_inventory(self, grid):
+        """Return the node inventory of a grid, fetching it when missing or old.
+
+        Inventories are refreshed in the background until they have not
+        been used for NODES_IDLE seconds.
+        """
+        with self.jenkins_lock:
+            inventory = self.inventories.get(grid)
+        if (inventory is None or time() - inventory.refreshed_at >
+                2 * self.config['NODE_REFRESH']):
+            inventory = self.refresh_inventory(grid)
+        inventory.used_at = time()
+        return inventory
+
+    def refresh_inventory(self, grid):
+        """Fetch every node of a grid in a single tree= query."""
+        inventory = NodeInventory.from_tree(
+            self.jenkins_tree(grid, 'computer/', NODES_TREE))
+        with self.jenkins_lock:
+            previous = self.inventories.get(grid)
+            if previous is not None:
+                inventory.used_at = previous.used_at
+            self.inventories[grid] = inventory
+        return inventory
+
+    def refresh_inventories(self):
+        """Keep the node inventories of the grids recently looked at up to date."""
+        with self.jenkins_lock:
+            grids = [grid for grid, inventory in self.inventories.items()
+                     if time() - inventory.used_at < NODES_IDLE]
+        self.refresh_grids(grids, self.refresh_inventory, 'node inventory')
+
+    def update_inventory(self, grid, update, *args, **kwargs):
+        """Apply a node command to the inventory of a grid, if it has one."""
+        with self.jenkins_lock:
+            inventory = self.inventories.get(grid)
+        if inventory is not None:
+            getattr(inventory, update)(*args, **kwargs)
 
     def set_jenkins_url(self, grid):
         """deploy to grid with the same name as the slack channel"""
+        try:
+            with self.metrics.timed('set_jenkins_url'):
+                self.config['URL'][grid] = self.discovery.resolve(grid)
+        except MasterUnavailable:
+            self.config['URL'][grid] = None
+            raise
+
+    def instance_api_url(self, grid):
+        """Return the instance API endpoint publishing a grid's master."""
         domain = os.environ['DOMAIN']
         server = 'master-{0}-alb.{1}'.format(grid, domain)
         try:
-            answers = query(server, 'A')
+            with self.metrics.timed('discovery.dns'):
+                query(server, 'A')
         except NXDOMAIN as e:
             self.log.debug('New instance api endpoint not supported: ' + str(e))
-            url = 'http://slave-{0}.{1}:3000/scripts/jenkins_url'.format(grid, domain)
-        else:
-            url = 'https://{}:3000/scripts/jenkins_url'.format(server)
+            return 'http://slave-{0}.{1}:3000/scripts/jenkins_url'.format(grid, domain)
+        return 'https://{}:3000/scripts/jenkins_url'.format(server)
 
-        for i in range(0,29):
-            try:
-                resp = requests.get(url, timeout=API_TIMEOUT).json()
-                regex = r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
-                if re.match(regex, resp['stdout'][0]) is None:
-                    self.config['URL'][grid] = None
-                    sleep(1)
-                    continue
-            except requests.ConnectionError as e:
-                self.log.warning('Connection timeout to Instance API endpoint: ' + str(e))
-                self.config['URL'][grid] = None
-                sleep(1)
-                continue
-            else:
-                self.config['URL'][grid] = 'http://' + resp['stdout'][0]
-                break
+    def fetch_jenkins_url(self, grid):
+        """Ask the instance API of a grid for its master, once."""
+        url = self.instance_api_url(grid)
+        try:
+            with self.metrics.timed('discovery.instance_api'):
+                return query_instance_api(url, self.session_for(grid))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.log.warning('Connection timeout to Instance API endpoint: ' + str(e))
+        except ValueError as e:
+            self.log.warning('Invalid answer from Instance API endpoint: ' + str(e))
+        return None
 
     @webhook(r'/jenkins/notification')
     def handle_notification(self, incoming_request):
@@ -225,54 +1928,155 @@ class JenkinsBot(BotPlugin):
             return 'Notification handling is disabled.'
 
         self.log.debug(repr(incoming_request))
+        with self.metrics.timed('notification.receive'):
+            self.coalescer.add(self.notification_key(incoming_request),
+                               incoming_request)
+        return
+
+    def queue_notification(self, incoming_request):
+        """Hand a coalesced notification over to the notification workers."""
+        if not self.notifications.put(incoming_request):
+            self.log.warning('Notification queue is full, dropping {0}'.format(
+                incoming_request.get('name')))
+
+    def notification_key(self, incoming_request):
+        """Return the (grid, job, build number) a notification is about."""
+        build = incoming_request['build']
+        return (self.router.route(build['full_url']),
+                incoming_request['name'], build['number'])
+
+    def process_notification(self, incoming_request):
+        """Enrich a queued notification with git data and broadcast it."""
+        with self.metrics.timed('notification.process'):
+            self.enrich_notification(incoming_request)
+
+    def enrich_notification(self, incoming_request):
         # parse incoming request url to find
         # the grid/channelname to post
-        url = incoming_request['build']['full_url']
-        m = re.match(r'https://master-(.*).' + os.environ['DOMAIN'], url)
-        grid  = m.group(1)
-        grid_channel = '#' + grid or '#deploy'
-        self.config['GRID_NOTIFICATION'] = ( grid_channel,)
-        job_name = incoming_request['name']
-        build_number = incoming_request['build']['number']
-        self.connect_to_jenkins(grid)
+        key = self.notification_key(incoming_request)
+        grid, job_name, build_number = key
+        if grid is None:
+            self.log.info('Unknown master for {0}'.format(
+                incoming_request['build']['full_url']))
+        grid_channel = '#' + grid if grid else '#deploy'
+        rooms = (grid_channel,)
+        # Builds have no revision until their checkout, so only found git
+        # metadata is kept: later phases fetch it again until it is there
+        git = self.git_metadata.get(key)
+        try:
+            if git is None and grid is not None:
+                self.connect_to_jenkins(grid)
+                with self.metrics.timed('notification.git'):
+                    git = self.fetch_git_metadata(grid, job_name,
+                                                  build_number)
+                if git:
+                    self.git_metadata.put(key, git)
+        except MasterUnavailable as e:
+            self.log.warning('Skipping build info for {0}: {1}'.format(job_name, e))
+        except CONNECTION_ERRORS as e:
+            self.invalidate_jenkins(grid)
+            self.log.warning('Skipping build info for {0}: {1}'.format(job_name, e))
+        except (JenkinsException, requests.HTTPError) as e:
+            self.log.warning('Skipping build info for {0}: {1}'.format(job_name, e))
+        if git:
+            incoming_request['git'] = git
+
+        self.broadcast(self.format_notification(incoming_request, True),
+                       True, rooms)
+        return
 
-        build_info = self.jenkins[grid].get_build_info(job_name, build_number)
-        bi = build_info['actions']
-        for i in range(0, len(bi)):
-            if bi[i].get('lastBuiltRevision') != None:
-                git_commit_id = bi[i]['lastBuiltRevision']['SHA1']
-                _url = bi[i]['remoteUrls'][0]
-                git_url = 'https://devgit.cloudpassage.com/' + \
-                        _url[_url.find('devgit')+7:].replace('_','/')
-                git_branch = bi[i]['lastBuiltRevision']['branch'][0]['name']
-                incoming_request['git'] = {}
-                incoming_request['git']['commit'] = git_commit_id
-                incoming_request['git']['url'] = git_url
-                incoming_request['git']['branch'] = git_branch
-                break
+    def fetch_git_metadata(self, grid, job_name, build_number):
+        """Fetch the git metadata of a build, and nothing else of its info."""
+        folder_url, short_name = self.jenkins[grid]._get_job_folder(job_name)
+        build = self.jenkins_tree(grid, BUILD_PATH, GIT_TREE,
+                                  folder_url=folder_url, short_name=short_name,
+                                  number=build_number)
+        return git_metadata(build.get('actions') or [])
 
-        self.broadcast(self.format_notification(incoming_request, True), True)
-        return
+    @botcmd
+    def jenkins_notifications(self, mess, args):
+        """Show how the notification queue is keeping up."""
+        return ('Notifications: {received} received, {merged} merged, '
+                '{processed} processed, {failed} failed, {dropped} dropped. '
+                'Queue: {queued}/{size} (peak {high_watermark}). '
+                'Chatrooms: {posted} posted, {waiting} waiting.'.format(
+                    merged=self.coalescer.merged,
+                    posted=self.outbox.sent, waiting=self.outbox.count(),
+                    **self.notifications.snapshot()))
+
+    @botcmd
+    def jenkins_stats(self, mess, args):
+        """Show where the plugin spends its time."""
+        with self.jenkins_lock:
+            breakers = sorted(self.breakers.items())
+        return self.format_stats(self.metrics.snapshot(), self.counters(),
+                                 self.gauges(), breakers)
+
+    @webhook(r'/jenkins/metrics', methods=('GET',))
+    def handle_metrics(self, incoming_request):
+        if not self.config['METRICS_ENDPOINT']:
+            return 'Metrics endpoint is disabled.'
+        return Response(self.metrics.prometheus(self.counters(), self.gauges()),
+                        content_type=METRICS_CONTENT_TYPE)
+
+    def counters(self):
+        stats = self.notifications.snapshot()
+        return {'discovery.retries': self.discovery.retries,
+                'notifications.received': stats['received'],
+                'notifications.merged': self.coalescer.merged,
+                'notifications.processed': stats['processed'],
+                'notifications.failed': stats['failed'],
+                'notifications.dropped': stats['dropped'],
+                'chat.posted': self.outbox.sent,
+                'breaker.trips': sum(breaker.trips for breaker in
+                                     list(self.breakers.values()))}
+
+    def gauges(self):
+        return {'notifications.queued': self.notifications.snapshot()['queued'],
+                'chat.waiting': self.outbox.count(),
+                'builds.tracked': len(self.tracker.builds),
+                'builds.followed': len(self.followers.builds),
+                'breaker.open': len([breaker for breaker in
+                                     list(self.breakers.values())
+                                     if breaker.state != CircuitBreaker.CLOSED])}
 
     @botcmd
+    @grid_command
     def jenkins_list(self, mess, args):
-        """List all jobs, optionally filter them using a search term."""
+        """List all jobs, optionally filter them using a search term.
+        Example: !jenkins list --all foo # search every grid
+        """
+        if args.split()[:1] == ['--all']:
+            term = args.strip()[len('--all'):].strip()
+            return self.fan_out(lambda grid: self.list_jobs(grid, term))
+
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
-        return self.format_jobs([job for job in self.jenkins[grid].get_jobs(folder_depth=None)
-            if args.lower() in job['fullname'].lower()])
+        return self.list_jobs(grid, args)
+
+    def list_jobs(self, grid, term):
+        return self.format_jobs(self.job_catalog(grid).search(term))
 
     @botcmd
+    @grid_command
     def jenkins_running(self, mess, args):
-        """List all running jobs."""
+        """List all running jobs.
+        Example: !jenkins running --all # on every grid
+        """
+        if args.strip() == '--all':
+            return self.fan_out(self.running_jobs)
+
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
+        return self.running_jobs(grid)
 
-        jobs = [job for job in self.jenkins[grid].get_jobs()
-                if 'anime' in job['color']]
-        return self.format_running_jobs(grid, jobs)
+    def running_jobs(self, grid):
+        jobs = self.jenkins_tree(grid, '', RUNNING_JOBS_TREE).get('jobs') or []
+        return self.format_running_jobs(
+            [job for job in jobs if 'anime' in (job.get('color') or '')])
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_param(self, mess, args):
         """List Parameters for a given job."""
         if len(args) == 0:
@@ -281,43 +2085,192 @@ class JenkinsBot(BotPlugin):
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
 
-        job = self.jenkins[grid].get_job_info(args[0])
-        if job['actions'][1] != {}:
-            job_param = job['actions'][1]['parameterDefinitions']
-        elif job['actions'][0] != {}:
-            job_param = job['actions'][0]['parameterDefinitions']
-        else:
-            job_param = []
-
-        return self.format_params(job_param)
+        return self.format_params(self.job_parameters(grid, args[0]))
+
+    def job_parameters(self, grid, job_name):
+        """Return the parameter definitions of a job, cached for CACHE_TTL."""
+        cached = self.parameters.get((grid, job_name))
+        if cached is not None and time() - cached[0] < self.config['CACHE_TTL']:
+            return cached[1]
+        return self.refresh_parameters(grid, job_name)
+
+    def refresh_parameters(self, grid, job_name):
+        """Fetch the parameter definitions of a job."""
+        folder_url, short_name = self.jenkins[grid]._get_job_folder(job_name)
+        definitions = parameter_definitions(self.jenkins_tree(
+            grid, JOB_PATH, PARAMETERS_TREE,
+            folder_url=folder_url, short_name=short_name))
+        self.parameters.put((grid, job_name), (time(), definitions))
+        return definitions
+
+    def invalidate_parameters(self, grid, job_name):
+        """Refetch the parameter definitions of a job on their next use."""
+        self.parameters.pop((grid, job_name))
+
+    def job_config(self, grid, job_name, max_age=None):
+        """Return the config.xml of a job, cached for max_age or CACHE_TTL.
+
+        Jenkins does not send validators for config.xml, so the cache
+        mostly relies on its TTL and on the bot dropping the jobs it
+        reconfigures. Copies that came with an ETag or a Last-Modified
+        date are revalidated with a conditional request once expired.
+        """
+        client = self.jenkins[grid]
+        cached = self.configs.get((grid, job_name))
+        headers = {}
+        if max_age is None:
+            max_age = self.config['CACHE_TTL']
+        if cached is not None:
+            if time() - cached['fetched_at'] < max_age:
+                return cached['xml']
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        folder_url, short_name = client._get_job_folder(job_name)
+        response = client.jenkins_request(requests.Request(
+            'GET', client._build_url(JOB_PATH + 'config.xml', {
+                'folder_url': folder_url, 'short_name': short_name}),
+            headers=headers), add_crumb=False)
+        if response.status_code == 304 and cached is not None:
+            cached['fetched_at'] = time()
+            return cached['xml']
+
+        response.encoding = 'utf-8'
+        config = {'xml': response.text, 'fetched_at': time(),
+                  'etag': response.headers.get('ETag'),
+                  'last_modified': response.headers.get('Last-Modified')}
+        self.configs.put((grid, job_name), config)
+        return config['xml']
+
+    def set_job_branch(self, grid, job_name, branch):
+        """Make a job build branch, returning False if it already did.
+
+        A cached config tells jobs already on branch apart, but only a
+        fresh one is rewritten, so that changes made since are kept.
+        """
+        job_xml = set_git_branch(self.job_config(grid, job_name), branch)
+        if job_xml is not None:
+            job_xml = set_git_branch(self.job_config(
+                grid, job_name, max_age=CONFIG_WRITE_AGE), branch)
+        if job_xml is None:
+            return False
+        try:
+            self.jenkins[grid].reconfig_job(job_name, job_xml)
+        finally:
+            self.configs.pop((grid, job_name))
+        self.invalidate_parameters(grid, job_name)
+        return True
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_output(self, mess, args):
         """Fetch latest jenkins buid output for a job."""
         if len(args) == 0:  # No Job name
-            return 'What job output would you like?'
+            yield 'What job output would you like?'
+            return
 
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
         job_name = args[0]
 
-        job = self.jenkins[grid].get_job_info(job_name)
-        if job['builds']:
-            last_run_number = job['builds'][0]['number']
-        else:
-            return 'job has not been build yet!'
+        last_run_number = self.last_build_number(grid, job_name)
+        if last_run_number is None:
+            yield 'job has not been build yet!'
+            return
 
         try:
-            console_output = self.jenkins[grid].get_build_console_output(job_name, last_run_number)
-        except:
-            return 'could not connect to jenkins'
-        else:
-            stream = io.BytesIO(console_output.encode())
+            response = open_console(self.jenkins[grid], job_name, last_run_number)
+        except CONNECTION_ERRORS:
+            self.invalidate_jenkins(grid)
+            yield 'could not connect to jenkins'
+            return
+        except JenkinsException as e:
+            yield 'could not fetch the job output: {0}'.format(e)
+            return
+        stream = io.BufferedReader(IterStream(iter_console(response)),
+                                   CONSOLE_CHUNK_SIZE)
 
         yield 'Fetching job output....'
         self.send_stream_request(mess.frm, stream, '{0} build #{1} output'.format(job_name, last_run_number))
 
     @botcmd(split_args_with=None)
+    @grid_command
+    def jenkins_tail(self, mess, args):
+        """Show the last lines of a job's latest build output.
+        Example: !jenkins tail foo 100
+        """
+        if len(args) == 0:  # No Job name
+            return 'What job output would you like?'
+        if len(args) > 1 and not (args[1].isdigit() and int(args[1]) > 0):
+            return 'The number of lines should be a positive number.'
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        job_name = args[0]
+        count = int(args[1]) if len(args) > 1 else TAIL_DEFAULT_LINES
+
+        last_run_number = self.last_build_number(grid, job_name)
+        if last_run_number is None:
+            return 'job has not been build yet!'
+
+        lines = tail_console(self.jenkins[grid], job_name, last_run_number, count)
+        return '{0} build #{1}, last {2} lines:\n{3}'.format(
+            job_name, last_run_number, len(lines), '\n'.join(lines))
+
+    @botcmd(split_args_with=None)
+    @grid_command
+    def jenkins_follow(self, mess, args):
+        """Post the output of a job's latest build while it runs.
+        Example: !jenkins follow foo
+        """
+        if len(args) == 0:  # No Job name
+            return 'What job would you like to follow?'
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        job_name = args[0]
+
+        last_run_number = self.last_build_number(grid, job_name)
+        if last_run_number is None:
+            return 'job has not been build yet!'
+
+        start = console_size(self.jenkins[grid], job_name, last_run_number)
+        self.followers.track({'grid': grid, 'job': job_name,
+                              'number': last_run_number, 'start': start,
+                              'to': mess.frm})
+        return 'Following {0} build #{1}...'.format(job_name, last_run_number)
+
+    def follow_build(self, build):
+        """Post the new output of a followed build, until it is over."""
+        grid = build['grid']
+        self.connect_to_jenkins(grid)
+        text, build['start'], running = read_console(
+            self.jenkins[grid], build['job'], build['number'], build['start'])
+        text = text.decode('utf-8', 'replace').rstrip()
+        if len(text) > FOLLOW_MAX_CHARS:
+            text = '...' + text[-FOLLOW_MAX_CHARS:]
+        if text:
+            self.send(build['to'], text)
+        if not running:
+            self.send(build['to'], '{0} build #{1} is over.'.format(
+                build['job'], build['number']))
+            return True
+        if time() - build['added'] >= FOLLOW_TIMEOUT:
+            self.send(build['to'], 'Stopped following {0} build #{1}.'.format(
+                build['job'], build['number']))
+            return True
+        return False
+
+    def last_build_number(self, grid, job_name):
+        """Return the number of the last build of a job, or None."""
+        folder_url, short_name = self.jenkins[grid]._get_job_folder(job_name)
+        job = self.jenkins_tree(grid, JOB_PATH, 'lastBuild[number]',
+                                folder_url=folder_url, short_name=short_name)
+        return (job.get('lastBuild') or {}).get('number')
+
+    @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_branch(self, mess, args):
         """ set a job git branch/commit id"""
         if len(args) < 2:  # No Job name or branch
@@ -327,21 +2280,60 @@ class JenkinsBot(BotPlugin):
         self.connect_to_jenkins(grid)
         job_name = args[0]
         branch = args[1]
-        if not self.jenkins[grid].job_exists(job_name):
-            return 'job name is invalid'
-
-        job_xml = self.jenkins[grid].get_job_config(job_name)
-        tree = et.fromstring(job_xml)
-        tree.find('.//hudson.plugins.git.BranchSpec/name').text = branch
-        new_job_xml = et.tostring(tree, encoding='utf-8')
         try:
-            self.jenkins[grid].reconfig_job(job_name, new_job_xml.decode('utf-8'))
-        except:
-            return 'failed to change the job build branch'
+            changed = self.set_job_branch(grid, job_name, branch)
+        except NotFoundException:
+            return 'job name is invalid'
+        except (JenkinsException, requests.HTTPError, ValueError,
+                et.ParseError) as e:
+            return 'failed to change the job build branch: {0}'.format(e)
 
+        if not changed:
+            return job_name + ' already builds ' + branch
         return job_name + ' branch was successfully changed to ' + branch
 
     @botcmd(split_args_with=None)
+    @grid_command
+    def jenkins_branchmany(self, mess, args):
+        """Set the git branch/commit id of several jobs at once
+        Example: !jenkins branchmany deploy-* release/1.2
+        Example: !jenkins branchmany api,frontend,worker release/1.2
+        """
+        if len(args) < 2:  # No Job names or branch
+            return 'missing job names or branch'
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        branch = args[1]
+
+        jobs, missing = self.resolve_jobs(grid, args[0])
+        if not jobs:
+            return 'No jobs found.'
+
+        def switch(job_name):
+            try:
+                if self.set_job_branch(grid, job_name, branch):
+                    return 'changed'
+                return 'unchanged'
+            except CONNECTION_ERRORS + (JenkinsException, requests.HTTPError,
+                                        ValueError, et.ParseError) as e:
+                return 'Oops, {0}'.format(e)
+
+        with ThreadPoolExecutor(
+                max_workers=self.config['BUILD_CONCURRENCY']) as executor:
+            results = list(executor.map(switch, jobs))
+
+        max_length = max([len(job_name) for job_name in jobs])
+        reply = ['Switched {0} of {1} jobs to {2}:'.format(
+            results.count('changed'), len(jobs), branch)]
+        reply.extend(['%s %s' % (job_name.ljust(max_length), result)
+                      for job_name, result in zip(jobs, results)])
+        if missing:
+            reply.append('Could not find: {0}'.format(', '.join(missing)))
+        return '\n'.join(reply)
+
+    @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_build(self, mess, args):
         """Build a Jenkins Job with the given parameters
         Example: !jenkins build test_project FOO:bar
@@ -351,17 +2343,130 @@ class JenkinsBot(BotPlugin):
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
         params = self.build_parameters(args[1:])
+        try:
+            queue_id = self.trigger_build(grid, args[0], params)
+        except JenkinsException as e:
+            return 'Oops, {0}'.format(e)
+
+        self.tracker.track({'grid': grid, 'job': args[0], 'queue_id': queue_id,
+                            'number': None, 'to': mess.frm})
+        return 'Your job should begin shortly: {0}'.format(
+            self.format_jobs([{'fullname': args[0],
+                               'url': self.job_url(grid, args[0])}]))
 
+    def job_url(self, grid, job_name):
+        """Return the public URL of a job, as reported by its master.
+
+        The client only knows the address the bot reaches the master at,
+        so building the URL from it is a last resort for unknown jobs.
+        """
+        job = self.job_catalog(grid).get(job_name)
+        if job is not None and job['url']:
+            return job['url']
+        folder_url, short_name = self.jenkins[grid]._get_job_folder(job_name)
+        return self.jenkins[grid]._build_url(
+            JOB_PATH, {'folder_url': folder_url, 'short_name': short_name})
+
+    def check_build(self, build):
+        """Report a tracked build once it starts and once it is over."""
+        grid = build['grid']
+        self.connect_to_jenkins(grid)
+        if build['number'] is None:
+            item = self.jenkins[grid].get_queue_item(build['queue_id'])
+            if item.get('cancelled'):
+                self.send(build['to'], '{0} was cancelled before it started.'.format(
+                    build['job']))
+                return True
+            if not item.get('executable'):
+                return False
+            build['number'] = item['executable']['number']
+            self.send(build['to'], '{0} #{1} has started: {2}'.format(
+                build['job'], build['number'], item['executable']['url']))
+            return False
+
+        folder_url, short_name = self.jenkins[grid]._get_job_folder(build['job'])
+        info = self.jenkins_tree(grid, BUILD_PATH, 'building,result,url',
+                                 folder_url=folder_url, short_name=short_name,
+                                 number=build['number'])
+        if info.get('building') or info.get('result') is None:
+            return False
+        self.send(build['to'], '{0} #{1} is over: {2} ({3})'.format(
+            build['job'], build['number'], info['result'], info['url']))
+        return True
+
+    def trigger_build(self, grid, job_name, params):
+        """Queue a build of a job, returning its queue item number.
+
+        Parameters are checked against the job's definitions first, so
+        mistakes are reported without a round trip to the master. Cached
+        definitions that do not fit them are fetched again before giving
+        up, in case the job changed since.
+        """
+        definitions = self.job_parameters(grid, job_name)
+        if (any(params) and not definitions or
+                definitions and check_parameters(definitions, params)):
+            definitions = self.refresh_parameters(grid, job_name)
         # Is it a parameterized job ?
-        job = self.jenkins[grid].get_job_info(args[0])
-        if job['actions'][0] == {} and job['actions'][1] == {}:
-            self.jenkins[grid].build_job(args[0])
-        else:
-            self.jenkins[grid].build_job(args[0], params)
+        if not definitions:
+            return self.jenkins[grid].build_job(job_name)
+        problems = check_parameters(definitions, params)
+        if problems:
+            raise InvalidParameters('{0}: {1}'.format(job_name, ', '.join(problems)))
+        return self.jenkins[grid].build_job(job_name, params)
 
-        running_job = self.search_job(grid, args[0])
-        return 'Your job should begin shortly: {0}'.format(
-            self.format_jobs(running_job))
+    @botcmd(split_args_with=None)
+    @grid_command
+    def jenkins_buildmany(self, mess, args):
+        """Build several Jenkins Jobs at once with the given parameters
+        Example: !jenkins buildmany deploy-* VERSION:1.2.0
+        Example: !jenkins buildmany api,frontend,worker VERSION:1.2.0
+        """
+        if len(args) == 0:  # No Job names
+            return 'What jobs would you like to build?'
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        params = self.build_parameters(args[1:])
+
+        jobs, missing = self.resolve_jobs(grid, args[0])
+        if not jobs:
+            return 'No jobs found.'
+
+        def trigger(job_name):
+            try:
+                return 'queue #{0}'.format(
+                    self.trigger_build(grid, job_name, params))
+            except CONNECTION_ERRORS + (JenkinsException,
+                                        requests.HTTPError) as e:
+                return 'Oops, {0}'.format(e)
+
+        with ThreadPoolExecutor(
+                max_workers=self.config['BUILD_CONCURRENCY']) as executor:
+            results = list(executor.map(trigger, jobs))
+
+        max_length = max([len(job_name) for job_name in jobs])
+        reply = ['Triggered {0} jobs:'.format(len(jobs))]
+        reply.extend(['%s %s' % (job_name.ljust(max_length), result)
+                      for job_name, result in zip(jobs, results)])
+        if missing:
+            reply.append('Could not find: {0}'.format(', '.join(missing)))
+        return '\n'.join(reply)
+
+    def resolve_jobs(self, grid, pattern):
+        """Return the buildable jobs designated by a shell-style pattern, a
+        job name or a comma separated list of names, along with the names
+        that were not found. Names must match exactly, so that a mass
+        command never reaches jobs only containing them.
+        """
+        catalog = self.job_catalog(grid)
+        if ',' not in pattern and re.search(r'[*?[]', pattern):
+            jobs, missing = catalog.match(pattern), []
+        else:
+            names = [name for name in pattern.split(',') if name]
+            jobs = [catalog.get(name) for name in names]
+            missing = [name for name, job in zip(names, jobs) if job is None]
+        # Folders have no color and cannot be built
+        return ([job['fullname'] for job in jobs
+                 if job is not None and job['color'] is not None], missing)
 
     @botcmd(split_args_with=None)
     def build(self, mess, args):
@@ -379,28 +2484,47 @@ class JenkinsBot(BotPlugin):
         return self.jenkins_build(mess, args)
 
     @botcmd
-    def jenkins_unqueue(self, msg, args):
-        """Cancel a queued job.
-        Example !jenkins unqueue foo
+    @grid_command
+    def jenkins_queue(self, mess, args):
+        """List the queued jobs, optionally filtered by a shell-style pattern.
+        Example !jenkins queue deploy-*
         """
         grid = mess.frm.channelname
         self.connect_to_jenkins(grid)
 
-        try:
-            queue = self.jenkins[grid].get_queue_info()
+        snapshot = self.queue_snapshot(grid)
+        return self.format_queue(snapshot.find(args) if args else snapshot.items)
 
-            job = next((job for job in queue if job['task']['name'].lower() == args.lower()), None)
+    @botcmd
+    @grid_command
+    def jenkins_unqueue(self, mess, args):
+        """Cancel queued jobs by name or shell-style pattern.
+        Example !jenkins unqueue foo
+        Example !jenkins unqueue deploy-*
+        """
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
 
-            if job:
-                self.jenkins[grid].cancel_queue(job['id'])
-                return 'Unqueued job {0}'.format(job['task']['name'])
+        try:
+            snapshot = self.queue_snapshot(grid)
+            jobs = snapshot.find(args)
+
+            if jobs:
+                for job in jobs:
+                    self.jenkins[grid].cancel_queue(job['id'])
+                with self.jenkins_lock:
+                    self.queues[grid] = snapshot.without(
+                        set(job['id'] for job in jobs))
+                return 'Unqueued job {0}'.format(
+                    ', '.join(job['task']['name'] for job in jobs))
             else:
                 return 'Could not find job {0}, but found the following: {1}'.format(
-                    args, ', '.join(job['task']['name'] for job in queue))
+                    args, ', '.join(job['task']['name'] for job in snapshot.items))
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_createjob(self, mess, args):
         """Create a Jenkins Job.
         Example: !jenkins createjob pipeline foo git@github.com:foo/bar.git
@@ -416,25 +2540,87 @@ class JenkinsBot(BotPlugin):
         self.connect_to_jenkins(grid)
 
         try:
-            if args[0] == 'pipeline':
-                self.jenkins[grid].create_job(
-                    args[1],
-                    JENKINS_JOB_TEMPLATE_PIPELINE.format(repository=args[2]))
-
-            elif args[0] == 'multibranch':
-                repository = args[2].rsplit('/', maxsplit=2)[-2:]
-
-                self.jenkins[grid].create_job(
-                    args[1],
-                    JENKINS_JOB_TEMPLATE_MULTIBRANCH.format(
-                        repo_owner=repository[0].split(':')[-1],
-                        repo_name=repository[1].strip('.git')))
+            self.jenkins[grid].create_job(
+                args[1], render_job_config(args[0], args[2]))
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
+        self.invalidate_catalog(grid)
+        self.invalidate_parameters(grid, args[1])
+        self.configs.pop((grid, args[1]))
         return 'Your job has been created: {0}/job/{1}'.format(
             self.config['URL'][grid], args[1])
 
+    @botcmd
+    @grid_command
+    def jenkins_provision(self, mess, args):
+        """Create or update the jobs of a JSON or YAML manifest. Jobs
+        already matching the manifest are left alone.
+        Example: !jenkins provision ["git@github.com:foo/api.git"]
+        Example: !jenkins provision --dry-run {"type": "multibranch", "jobs": ["git@github.com:foo/api.git"]}
+        """
+        dry_run = args.split()[:1] == ['--dry-run']
+        if dry_run:
+            args = args.strip()[len('--dry-run'):]
+        source = args.strip()
+        if not source:
+            return 'Oops, I need a manifest.'
+
+        try:
+            jobs = load_manifest(source)
+            for job in jobs:
+                job['config'] = render_job_config(job['type'], job['repository'])
+        except ValueError as e:
+            return 'Oops, {0}'.format(e)
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        catalog = self.job_catalog(grid)
+
+        def provision(job):
+            started = time()
+            try:
+                if catalog.get(job['name']) is None:
+                    action = 'created'
+                    if not dry_run:
+                        self.jenkins[grid].create_job(job['name'], job['config'])
+                elif same_config(self.job_config(grid, job['name']),
+                                 job['config']):
+                    action = 'unchanged'
+                else:
+                    action = 'updated'
+                    if not dry_run:
+                        self.jenkins[grid].reconfig_job(job['name'], job['config'])
+            except CONNECTION_ERRORS + (JenkinsException,
+                                        requests.HTTPError) as e:
+                action = 'Oops, {0}'.format(e)
+            if action in ('created', 'updated') and not dry_run:
+                self.invalidate_parameters(grid, job['name'])
+                self.configs.pop((grid, job['name']))
+            return action, time() - started
+
+        started = time()
+        with ThreadPoolExecutor(
+                max_workers=self.config['BUILD_CONCURRENCY']) as executor:
+            results = list(executor.map(provision, jobs))
+        if not dry_run:
+            self.invalidate_catalog(grid)
+
+        actions = [action for action, _ in results]
+        counts = dict((action, actions.count(action))
+                      for action in ('created', 'updated', 'unchanged'))
+        max_length = max([len(job['name']) for job in jobs])
+        reply = ['{0} {1} jobs in {2:.1f}s: {created} created, {updated} '
+                 'updated, {unchanged} unchanged, {failed} failed'.format(
+                     'Would provision' if dry_run else 'Provisioned',
+                     len(jobs), time() - started,
+                     failed=len(jobs) - sum(counts.values()), **counts)]
+        reply.extend(['%s %s (%.2fs)' % (job['name'].ljust(max_length),
+                                         action, elapsed)
+                      for job, (action, elapsed) in zip(jobs, results)])
+        return '\n'.join(reply)
+
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_deletejob(self, mess, args):
         """Delete a Jenkins Job.
         Example: !jenkins deletejob foo
@@ -450,9 +2636,13 @@ class JenkinsBot(BotPlugin):
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
 
+        self.invalidate_catalog(grid)
+        self.invalidate_parameters(grid, args[0])
+        self.configs.pop((grid, args[0]))
         return 'Your job has been deleted.'
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_enablejob(self, mess, args):
         """Enable a Jenkins Job.
         Example: !jenkins enablejob foo
@@ -471,6 +2661,7 @@ class JenkinsBot(BotPlugin):
         return 'Your job has been enabled.'
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_disablejob(self, mess, args):
         """Disable a Jenkins Job.
         Example: !jenkins disablejob foo
@@ -489,6 +2680,7 @@ class JenkinsBot(BotPlugin):
         return 'Your job has been disabled.'
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_createnode(self, mess, args):
         """Create a Jenkins Node with a JNLP Launcher with optionnal labels.
         Example: !jenkins createnode runner-foo-laptop /home/foo # without labels
@@ -509,11 +2701,16 @@ class JenkinsBot(BotPlugin):
                 launcher=LAUNCHER_JNLP)
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
+        # JNLP agents are offline until they connect
+        self.update_inventory(grid, 'put', {
+            'name': args[0], 'offline': True, 'idle': True,
+            'executors': 2, 'labels': sorted(args[2:])})
 
         return 'Your node has been created: {0}/computer/{1}'.format(
             self.config['URL'][grid], args[0])
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_deletenode(self, mess, args):
         """Delete a Jenkins Node.
         Example: !jenkins deletenode runner-foo-laptop
@@ -528,10 +2725,12 @@ class JenkinsBot(BotPlugin):
             self.jenkins[grid].delete_node(args[0])
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
+        self.update_inventory(grid, 'remove', args[0])
 
         return 'Your node has been deleted.'
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_enablenode(self, mess, args):
         """Enable a Jenkins Node.
         Example: !jenkins enablenode runner-foo-laptop
@@ -546,10 +2745,13 @@ class JenkinsBot(BotPlugin):
             self.jenkins[grid].enable_node(args[0])
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
+        # An enabled node stays offline until its agent is connected
+        self.update_inventory(grid, 'expire')
 
         return 'Your node has been enabled.'
 
     @botcmd(split_args_with=None)
+    @grid_command
     def jenkins_disablenode(self, mess, args):
         """Disable a Jenkins Node.
         Example: !jenkins disablenode runner-foo-laptop
@@ -564,24 +2766,102 @@ class JenkinsBot(BotPlugin):
             self.jenkins[grid].disable_node(args[0])
         except JenkinsException as e:
             return 'Oops, {0}'.format(e)
+        self.update_inventory(grid, 'update', args[0], offline=True)
 
         return 'Your node has been disabled.'
 
-    def search_job(self, grid, search_term):
-        self.log.debug('Querying Jenkins for job "{0}"'.format(search_term))
-        return [job for job in self.jenkins[grid].get_jobs(folder_depth=None)
-                if search_term.lower() == job['fullname'].lower()]
+    @botcmd
+    @grid_command
+    def jenkins_nodes(self, mess, args):
+        """List the nodes of the grid, optionally those with a label or
+        whose name matches a shell-style pattern.
+        Example: !jenkins nodes docker
+        Example: !jenkins nodes --all runner-* # on every grid
+        """
+        if args.split()[:1] == ['--all']:
+            term = args.strip()[len('--all'):].strip()
+            return self.fan_out(lambda grid: self.list_nodes(grid, term))
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        return self.list_nodes(grid, args.strip())
+
+    def list_nodes(self, grid, term=''):
+        return self.format_nodes(self.node_inventory(grid).find(term))
 
-    def format_running_jobs(self, grid, jobs):
+    @botcmd
+    @grid_command
+    def jenkins_executors(self, mess, args):
+        """Count the executors of the grid, in total and per label.
+        Example: !jenkins executors --all # of every grid
+        """
+        if args.strip() == '--all':
+            return self.fan_out(self.count_executors)
+
+        grid = mess.frm.channelname
+        self.connect_to_jenkins(grid)
+        return self.count_executors(grid)
+
+    def count_executors(self, grid):
+        return self.format_executors(self.node_inventory(grid).executors())
+
+    @staticmethod
+    def format_running_jobs(jobs):
         if len(jobs) == 0:
             return 'No running jobs.'
 
-        jobs_info = [self.jenkins[grid].get_job_info(job['name']) for job in jobs]
         return '\n\n'.join(['%s (%s)\n%s' % (
             job['name'],
-            job['lastBuild']['url'],
-            job['healthReport'][0]['description'])
-                            for job in jobs_info]).strip()
+            (job.get('lastBuild') or {}).get('url', ''),
+            (job.get('healthReport') or [{}])[0].get('description', ''))
+                            for job in jobs]).strip()
+
+    @staticmethod
+    def format_nodes(nodes):
+        if len(nodes) == 0:
+            return 'No nodes found.'
+
+        def status(node):
+            status = ['offline' if node['offline'] else 'online']
+            if not node['offline'] and 'idle' in node:
+                status.append('idle' if node['idle'] else 'busy')
+            if 'executors' in node:
+                status.append('%d executors' % node['executors'])
+            return '(%s) %s' % (', '.join(status),
+                                ' '.join(node.get('labels') or []))
+
+        max_length = max([len(node['name']) for node in nodes])
+        return '\n'.join(
+            [('%s %s' % (node['name'].ljust(max_length), status(node))).strip()
+             for node in nodes]).strip()
+
+    @staticmethod
+    def format_executors(summary):
+        if len(summary) == 0:
+            return 'No nodes found.'
+
+        names = ['all nodes' if label is None else label for label in summary]
+        max_length = max([len(name) for name in names])
+        return '\n'.join(
+            ['%s %d executors on %d nodes, %d online, %d idle' % (
+                name.ljust(max_length), counts['executors'], counts['nodes'],
+                counts['online'], counts['idle'])
+             for name, counts in zip(names, summary.values())]).strip()
+
+    @staticmethod
+    def format_queue(items):
+        if len(items) == 0:
+            return 'The queue is empty.'
+
+        now = time() * 1000
+        max_length = max([len(item['task']['name']) for item in items])
+        return '\n'.join(
+            ['%s #%s, queued %d min ago: %s' % (
+                item['task']['name'].ljust(max_length), item['id'],
+                (now - item.get('inQueueSince', now)) // 60000,
+                item.get('why') or '')
+             for item in items]).strip()
+
     @staticmethod
     def format_jobs(jobs):
         if len(jobs) == 0:
@@ -597,13 +2877,7 @@ class JenkinsBot(BotPlugin):
         """Format job parameters."""
         if len(job) == 0:
             return 'This job is not parameterized.'
-        PARAM_TEMPLATE = Template("""{% for p in params %}Type: {{p.type}}
-Description: {{p.description}}
-Default Value: {{p.defaultParameterValue.value}}
-Parameter Name: {{p.name}}
-
-{% endfor %}""")
-        return PARAM_TEMPLATE.render({'params': job})
+        return render_template('params.txt', {'params': job})
 
     @staticmethod
     def format_notification(body, use_card):
@@ -625,13 +2899,39 @@ Parameter Name: {{p.name}}
             }
             return card
         else:
-            NOTIFICATION_TEMPLATE = Template("""Build #{{build.number}} \
-{{build.phase}} {{build.status}} for Job {{fullname}} ({{build.full_url}})
-{% if build.scm %}Based on {{build.scm.url}}/commit/{{build.scm.commit}} \
-({{build.scm.branch}}){% endif %} \
-{% if git %}Based on {{git.url}}/commit/{{git.commit}} \
-({{git.branch}}){% endif %}""")
-            return NOTIFICATION_TEMPLATE.render(body)
+            return render_template('notification.txt', body)
+
+    @staticmethod
+    def format_stats(operations, counters, gauges, breakers=()):
+        if len(operations) == 0:
+            lines = ['No operation timed yet.']
+        else:
+            max_length = max([len(name) for name in operations])
+            lines = ['%s %d calls, %d errors, p50 %dms, p95 %dms, p99 %dms' % (
+                name.ljust(max_length), operation['count'],
+                operation['errors'], operation['p50'] * 1000,
+                operation['p95'] * 1000, operation['p99'] * 1000)
+                for name, operation in operations.items()]
+        lines.append(', '.join('%s: %s' % item for item in
+                               sorted(chain(dict(counters).items(),
+                                            dict(gauges).items()))))
+        if breakers:
+            lines.append('Grids: ' + ', '.join(
+                '%s %s' % (grid, breaker.state) +
+                (' (retry in %ds)' % breaker.retry_in()
+                 if breaker.state != CircuitBreaker.CLOSED else '')
+                for grid, breaker in breakers))
+        return '\n'.join(lines).strip()
+
+    @staticmethod
+    def format_digest(messages):
+        lines = []
+        for mess, use_card in messages:
+            if use_card:
+                link = mess.get('link')
+                mess = mess['body'] + (' ' + link if link else '')
+            lines.append(mess.strip())
+        return '{0} notifications:\n{1}'.format(len(lines), '\n'.join(lines))
 
     @staticmethod
     def build_parameters(params):
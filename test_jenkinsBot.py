@@ -1,9 +1,71 @@
 # coding: utf-8
+import io
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+import requests
 from errbot.backends.test import testbot
+from jenkins import Jenkins, JenkinsException, NotFoundException
 
 import jenkinsBot
 
 
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Message(object):
+    """A message sent from the foo grid's chatroom."""
+    class frm(object):
+        channelname = 'foo'
+
+
+@contextmanager
+def stub_server(handler):
+    """Serve handler on a local port, yielding the server URL."""
+    server = StubServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def instance_api():
+    """A fake instance API answering slowly with a master address."""
+    state = {'hits': 0, 'stdout': ['10.0.0.1'], 'delay': 0.2}
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            state['hits'] += 1
+            time.sleep(state['delay'])
+            body = json.dumps({'stdout': state['stdout']}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    with stub_server(Handler) as url:
+        state['url'] = url + '/scripts/jenkins_url'
+        yield state
+
+
 class TestJenkinsBot(object):
     extra_plugin_dir = '.'
 
@@ -22,6 +84,31 @@ class TestJenkinsBot(object):
         assert ('What Job would you like the parameters for?'
                 in testbot.pop_message())
 
+    def test_jenkins_tail_no_args(self, testbot):
+        testbot.push_message('!jenkins tail')
+        assert ('What job output would you like?'
+                in testbot.pop_message())
+
+    def test_jenkins_tail_zero_lines(self, testbot):
+        testbot.push_message('!jenkins tail foo 0')
+        assert ('The number of lines should be a positive number.'
+                in testbot.pop_message())
+
+    def test_jenkins_follow_no_args(self, testbot):
+        testbot.push_message('!jenkins follow')
+        assert ('What job would you like to follow?'
+                in testbot.pop_message())
+
+    def test_jenkins_buildmany_no_args(self, testbot):
+        testbot.push_message('!jenkins buildmany')
+        assert ('What jobs would you like to build?'
+                in testbot.pop_message())
+
+    def test_jenkins_branchmany_no_args(self, testbot):
+        testbot.push_message('!jenkins branchmany deploy-*')
+        assert ('missing job names or branch'
+                in testbot.pop_message())
+
     def test_jenkins_createjob_no_args(self, testbot):
         testbot.push_message('!jenkins createjob')
         assert ('Oops, I need a type and a name for your new job.'
@@ -62,6 +149,1050 @@ class TestJenkinsBot(object):
         assert ('Oops, I need the name of the node you want me to disable.'
                 in testbot.pop_message())
 
+
+@pytest.fixture
+def console_server():
+    """A fake master whose build log is only half written at first."""
+    state = {'starts': [], 'head': b'x' * 128 * 1024, 'tail': b'y' * 1024,
+             'delay': 0.5}
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            state['starts'].append(self.path.split('start=')[-1])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('X-Text-Size', str(len(state['head']) +
+                                                len(state['tail'])))
+            self.end_headers()
+            self.wfile.write(state['head'])
+            self.wfile.flush()
+            time.sleep(state['delay'])
+            self.wfile.write(state['tail'])
+    with stub_server(Handler) as url:
+        state['url'] = url
+        yield state
+
+
+@pytest.fixture
+def log_server():
+    """A fake master serving a build log from any offset."""
+    lines = ['line {0}'.format(i) for i in range(1000)]
+    state = {'starts': [], 'log': '\n'.join(lines).encode() + b'\n',
+             'running': False}
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            start = int(self.path.split('start=')[-1])
+            state['starts'].append(start)
+            body = state['log'][start:]
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Text-Size', str(len(state['log'])))
+            if state['running']:
+                self.send_header('X-More-Data', 'true')
+            self.end_headers()
+            self.wfile.write(body)
+    with stub_server(Handler) as url:
+        state['url'] = url
+        yield state
+
+
+JOB_CONFIG = """<?xml version='1.0' encoding='UTF-8'?>
+<project>
+  <scm class="hudson.plugins.git.GitSCM">
+    <branches>
+      <hudson.plugins.git.BranchSpec>
+        <name>{0}</name>
+      </hudson.plugins.git.BranchSpec>
+    </branches>
+  </scm>
+</project>"""
+
+
+@pytest.fixture
+def config_server():
+    """A fake master serving a job config.xml, with an ETag by default."""
+    state = {'config': JOB_CONFIG.format('master'), 'version': 1,
+             'etag': True, 'requests': 0, 'downloads': 0, 'uploads': 0}
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            etag = '"{0}"'.format(state['version'])
+            if not self.path.endswith('/config.xml'):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            state['requests'] += 1
+            if state['etag'] and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            state['downloads'] += 1
+            body = state['config'].encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            if state['etag']:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            state['config'] = self.rfile.read(length).decode()
+            state['version'] += 1
+            state['uploads'] += 1
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+    with stub_server(Handler) as url:
+        state['url'] = url
+        yield state
+
+
+class TestJenkinsBotClientCache(object):
+    extra_plugin_dir = '.'
+
+    def test_connect_to_jenkins_reuses_client(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        lookups = []
+
+        def set_jenkins_url(grid):
+            lookups.append(grid)
+            plugin.config['URL'][grid] = 'http://10.0.0.1'
+        monkeypatch.setattr(plugin, 'set_jenkins_url', set_jenkins_url)
+
+        plugin.connect_to_jenkins('foo')
+        client = plugin.jenkins['foo']
+        plugin.connect_to_jenkins('foo')
+        assert lookups == ['foo']
+        assert plugin.jenkins['foo'] is client
+
+        plugin.invalidate_jenkins('foo')
+        plugin.connect_to_jenkins('foo')
+        assert lookups == ['foo', 'foo']
+
+
+    def test_refresh_grids_logs_failures(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        invalidated, refreshed = [], []
+        monkeypatch.setattr(plugin, 'invalidate_jenkins', invalidated.append)
+
+        def refresh(grid):
+            if grid == 'bar':
+                raise requests.ConnectionError()
+            refreshed.append(grid)
+        plugin.refresh_grids(['bar', 'foo'], refresh, 'job catalog')
+        assert refreshed == ['foo']
+        assert invalidated == ['bar']
+
+    def test_connect_to_jenkins_fails_fast_when_grid_is_down(
+            self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        lookups = []
+        monkeypatch.setattr(plugin, 'set_jenkins_url', lookups.append)
+
+        plugin.discovery_done('foo', False)
+        with pytest.raises(Exception) as e:
+            plugin.connect_to_jenkins('foo')
+        assert type(e.value).__name__ == 'GridDown'
+        assert 'foo master is unreachable' in str(e.value)
+        assert lookups == []
+        assert plugin.gauges()['breaker.open'] == 1
+
+
+class TestNotificationGitMetadata(object):
+    extra_plugin_dir = '.'
+
+    @staticmethod
+    def notification(phase):
+        return {'name': 'dummy', 'build': {
+            'full_url': 'http://10.0.0.1/job/dummy/1/', 'number': 1,
+            'phase': phase, 'status': 'SUCCESS'}}
+
+    @pytest.fixture
+    def plugin(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.router.learn('http://10.0.0.1', 'foo')
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        self.cards = []
+        monkeypatch.setattr(plugin, 'broadcast',
+                            lambda mess, use_card, rooms: self.cards.append(mess))
+        return plugin
+
+    def test_fetches_again_until_checked_out(self, plugin, monkeypatch):
+        fetched = []
+        found = {'commit': '0e51ed1', 'branch': 'master',
+                 'url': 'https://devgit.cloudpassage.com/foo/bar'}
+
+        def fetch_git_metadata(grid, job_name, build_number):
+            fetched.append(grid)
+            return found if len(fetched) > 1 else {}
+        monkeypatch.setattr(plugin, 'fetch_git_metadata', fetch_git_metadata)
+
+        for phase in ('STARTED', 'COMPLETED', 'FINALIZED'):
+            plugin.enrich_notification(self.notification(phase))
+        assert fetched == ['foo', 'foo']
+        assert [card['title'] for card in self.cards] == ['', '0e51ed', '0e51ed']
+        assert self.cards[2]['link'] == \
+            'https://devgit.cloudpassage.com/foo/bar/commit/0e51ed1'
+
+    def test_broadcasts_without_git_on_jenkins_errors(self, plugin, monkeypatch):
+        def fetch_git_metadata(grid, job_name, build_number):
+            raise NotFoundException()
+        monkeypatch.setattr(plugin, 'fetch_git_metadata', fetch_git_metadata)
+
+        plugin.enrich_notification(self.notification('QUEUED'))
+        assert len(self.cards) == 1
+        assert self.cards[0]['link'] == ''
+
+
+class TestFollow(object):
+    extra_plugin_dir = '.'
+
+    def test_posts_new_output_until_over(self, testbot, log_server, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(log_server['url'])
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        sent = []
+        monkeypatch.setattr(plugin, 'send', lambda to, text: sent.append(text))
+        log_server['running'] = True
+        build = {'grid': 'foo', 'job': 'bar', 'number': 1, 'to': None,
+                 'start': len(log_server['log']), 'added': time.time()}
+
+        assert not plugin.follow_build(build)
+        assert sent == []
+        log_server['log'] += b'line 1000\n'
+        log_server['running'] = False
+        assert plugin.follow_build(build)
+        assert sent == ['line 1000', 'bar build #1 is over.']
+
+
+class TestWarmStart(object):
+    extra_plugin_dir = '.'
+
+    def test_restores_saved_caches(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.config['URL']['foo'] = 'http://10.0.0.1'
+        plugin.open_client('foo')
+        plugin.catalogs['foo'] = jenkinsBot.JobCatalog([
+            {'name': 'bar', 'fullname': 'bar', 'url': 'job/bar/',
+             'color': 'blue'}])
+        plugin.parameters.put(('foo', 'bar'), (time.time(), [{'name': 'X'}]))
+        plugin.save_warm_start()
+
+        plugin.jenkins, plugin.jenkins_connected, plugin.catalogs = {}, {}, {}
+        plugin.parameters = jenkinsBot.LRUCache(10)
+        revalidated = []
+        monkeypatch.setattr(plugin, 'revalidate_grid',
+                            lambda *args: revalidated.append(args))
+        plugin.load_warm_start()
+
+        assert plugin.jenkins['foo'].server == 'http://10.0.0.1/'
+        assert plugin.catalogs['foo'].get('BAR')['url'] == 'job/bar/'
+        assert plugin.job_parameters('foo', 'bar') == [{'name': 'X'}]
+        assert plugin.parameters.get(('foo', 'bar'))[0] == \
+            plugin[jenkinsBot.WARM_START_KEY]['grids']['foo']['saved_at']
+        plugin.executor.shutdown(wait=True)
+        assert revalidated == [('foo', 'http://10.0.0.1', ['bar'])]
+
+    def test_ignores_other_versions(self, testbot):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin[jenkinsBot.WARM_START_KEY] = {'version': 0, 'grids': {
+            'foo': {'url': 'http://10.0.0.1', 'saved_at': time.time(),
+                    'catalog': [], 'parameters': {}}}}
+        plugin.jenkins = {}
+        plugin.load_warm_start()
+        assert plugin.jenkins == {}
+
+
+class TestJobConfigCache(object):
+    extra_plugin_dir = '.'
+
+    def test_revalidates_cached_config(self, testbot, config_server):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(config_server['url'])
+        plugin.config['CACHE_TTL'] = 0
+        assert plugin.job_config('foo', 'bar') == JOB_CONFIG.format('master')
+        assert plugin.job_config('foo', 'bar') == JOB_CONFIG.format('master')
+        assert config_server['downloads'] == 1
+        assert config_server['requests'] == 2
+
+    def test_caches_config_without_validators(self, testbot, config_server):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(config_server['url'])
+        config_server['etag'] = False
+        assert plugin.job_config('foo', 'bar') == JOB_CONFIG.format('master')
+        assert plugin.job_config('foo', 'bar') == JOB_CONFIG.format('master')
+        assert config_server['requests'] == 1
+
+    def test_skips_jobs_already_on_branch(self, testbot, config_server):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(config_server['url'])
+        assert plugin.set_job_branch('foo', 'bar', 'release') is True
+        assert '<name>release</name>' in config_server['config']
+        assert plugin.set_job_branch('foo', 'bar', 'release') is False
+        assert config_server['uploads'] == 1
+
+    def test_rewrites_fresh_config_only(self, testbot, config_server):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(config_server['url'])
+        config_server['etag'] = False
+        plugin.job_config('foo', 'bar')
+        plugin.configs.get(('foo', 'bar'))['fetched_at'] -= 10
+        config_server['config'] = JOB_CONFIG.format('master').replace(
+            '<project>', '<project>\n  <description>edited</description>')
+        assert plugin.set_job_branch('foo', 'bar', 'release') is True
+        assert '<description>edited</description>' in config_server['config']
+        assert '<name>release</name>' in config_server['config']
+
+
+class TestMetricsEndpoint(object):
+    extra_plugin_dir = '.'
+
+    def test_serves_prometheus_text(self, testbot):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.config['METRICS_ENDPOINT'] = True
+        response = plugin.handle_metrics('')
+        assert response.content_type == jenkinsBot.METRICS_CONTENT_TYPE
+        assert b'jenkinsbot_chat_waiting 0\n' in response.get_data()
+
+
+class TestNodeCommands(object):
+    extra_plugin_dir = '.'
+
+    def test_enabled_node_is_fetched_again(self, testbot, monkeypatch):
+        class Client(object):
+            def enable_node(self, name):
+                pass
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Client()
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        inventory = jenkinsBot.NodeInventory([
+            {'name': 'runner', 'offline': True, 'idle': True, 'executors': 2,
+             'labels': []}])
+        plugin.inventories['foo'] = inventory
+        refreshed = []
+        monkeypatch.setattr(plugin, 'refresh_inventory',
+                            lambda grid: refreshed.append(grid) or inventory)
+
+        assert plugin.jenkins_enablenode(Message, ['runner']) == \
+            'Your node has been enabled.'
+        assert inventory.find()[0]['offline'] is True
+        plugin.node_inventory('foo')
+        assert refreshed == ['foo']
+
+
+class TestBuildMany(object):
+    extra_plugin_dir = '.'
+
+    def plugin(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        monkeypatch.setattr(plugin, 'job_catalog', lambda grid: (
+            jenkinsBot.JobCatalog([
+                {'name': name, 'fullname': name, 'url': 'job/%s/' % name,
+                 'color': 'blue'} for name in ('api', 'api-tests', 'rapid')])))
+        return plugin
+
+    def test_bare_name_matches_exactly(self, testbot, monkeypatch):
+        plugin = self.plugin(testbot, monkeypatch)
+        assert plugin.resolve_jobs('foo', 'api') == (['api'], [])
+        assert plugin.resolve_jobs('foo', 'ap') == ([], ['ap'])
+        assert plugin.resolve_jobs('foo', 'api*') == (['api', 'api-tests'], [])
+
+    def test_job_url_is_public_url(self, testbot, monkeypatch):
+        plugin = self.plugin(testbot, monkeypatch)
+        plugin.jenkins['foo'] = Jenkins('http://10.0.0.1')
+        assert plugin.job_url('foo', 'API') == 'job/api/'
+        assert plugin.job_url('foo', 'infra/db') == \
+            'http://10.0.0.1/job/infra/job/db/'
+
+    def test_branchmany_reports_connection_errors_per_job(self, testbot,
+                                                          monkeypatch):
+        plugin = self.plugin(testbot, monkeypatch)
+
+        def set_job_branch(grid, job_name, branch):
+            if job_name == 'rapid':
+                raise requests.ConnectionError('Connection reset')
+            return True
+        monkeypatch.setattr(plugin, 'set_job_branch', set_job_branch)
+        reply = plugin.jenkins_branchmany(Message, ['*', 'release'])
+        assert reply.splitlines() == [
+            'Switched 2 of 3 jobs to release:',
+            'api       changed',
+            'api-tests changed',
+            'rapid     Oops, Connection reset']
+
+    def test_refetches_parameters_before_rejecting(self, testbot, monkeypatch):
+        class Client(object):
+            def build_job(self, name, parameters=None):
+                built.append((name, parameters))
+                return 7
+        built = []
+        plugin = self.plugin(testbot, monkeypatch)
+        plugin.jenkins['foo'] = Client()
+        plugin.parameters.put(('foo', 'api'), (time.time(), [{'name': 'A'}]))
+        monkeypatch.setattr(plugin, 'refresh_parameters', lambda grid, job_name: (
+            [{'name': 'A'}, {'name': 'B'}]))
+
+        assert plugin.trigger_build('foo', 'api', {'B': '1'}) == 7
+        assert built == [('api', {'B': '1'})]
+        with pytest.raises(Exception) as e:
+            plugin.trigger_build('foo', 'api', {'C': '1'})
+        assert 'unknown parameter C' in str(e.value)
+
+    def test_reports_http_errors_per_job(self, testbot, monkeypatch):
+        plugin = self.plugin(testbot, monkeypatch)
+
+        def trigger_build(grid, job_name, params):
+            if job_name == 'rapid':
+                raise requests.HTTPError('503 Server Error')
+            return 7
+        monkeypatch.setattr(plugin, 'trigger_build', trigger_build)
+        reply = plugin.jenkins_buildmany(Message, ['*', 'VERSION:1'])
+        assert reply.splitlines() == [
+            'Triggered 3 jobs:',
+            'api       queue #7',
+            'api-tests queue #7',
+            'rapid     Oops, 503 Server Error']
+
+
+class TestProvisioning(object):
+    extra_plugin_dir = '.'
+
+    def plugin(self, testbot, config_server, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('JenkinsBot')
+        plugin.jenkins['foo'] = Jenkins(config_server['url'])
+        monkeypatch.setattr(plugin, 'connect_to_jenkins', lambda grid: None)
+        monkeypatch.setattr(plugin, 'job_catalog', lambda grid: (
+            jenkinsBot.JobCatalog([{'name': 'bar', 'fullname': 'bar',
+                                    'url': 'job/bar/', 'color': 'blue'}])))
+        return plugin
+
+    def test_dry_run(self, testbot, config_server, monkeypatch):
+        plugin = self.plugin(testbot, config_server, monkeypatch)
+        reply = plugin.jenkins_provision(Message, '--dry-run ' + json.dumps(
+            ['git@github.com:foo/bar.git', 'git@github.com:foo/baz.git']))
+        lines = reply.splitlines()
+        assert lines[0].startswith('Would provision 2 jobs in ')
+        assert lines[0].endswith(
+            '1 created, 1 updated, 0 unchanged, 0 failed')
+        assert lines[1].startswith('bar updated (')
+        assert lines[2].startswith('baz created (')
+        assert config_server['uploads'] == 0
+
+    def test_leaves_matching_jobs_alone(self, testbot, config_server,
+                                        monkeypatch):
+        plugin = self.plugin(testbot, config_server, monkeypatch)
+        config_server['config'] = jenkinsBot.render_job_config(
+            'pipeline', 'git@github.com:foo/bar.git').replace('  ', '    ')
+        reply = plugin.jenkins_provision(
+            Message, '{"jobs": [{"repository": "git@github.com:foo/bar.git"}]}')
+        assert reply.splitlines()[0].endswith(
+            '0 created, 0 updated, 1 unchanged, 0 failed')
+        assert config_server['uploads'] == 0
+
+    def test_reports_connection_errors_per_job(self, testbot, config_server,
+                                               monkeypatch):
+        plugin = self.plugin(testbot, config_server, monkeypatch)
+
+        def create_job(name, config):
+            if name == 'baz':
+                raise requests.ConnectionError('Connection reset')
+        monkeypatch.setattr(plugin.jenkins['foo'], 'create_job', create_job)
+        reply = plugin.jenkins_provision(Message, json.dumps(
+            ['git@github.com:foo/baz.git', 'git@github.com:foo/qux.git']))
+        lines = reply.splitlines()
+        assert lines[0].endswith('1 created, 0 updated, 0 unchanged, 1 failed')
+        assert lines[1].startswith('baz Oops, Connection reset (')
+        assert lines[2].startswith('qux created (')
+
+    def test_invalid_manifest(self, testbot, config_server, monkeypatch):
+        plugin = self.plugin(testbot, config_server, monkeypatch)
+        assert plugin.jenkins_provision(Message, '{"jobs": []}') == \
+            'Oops, the manifest has no jobs'
+
+    def test_does_not_fetch_urls(self, testbot, config_server, monkeypatch):
+        plugin = self.plugin(testbot, config_server, monkeypatch)
+        monkeypatch.setattr(requests, 'get', None)
+        reply = plugin.jenkins_provision(
+            Message, 'http://169.254.169.254/latest/user-data')
+        assert reply.startswith('Oops, the manifest ')
+
+
+class TestGridRouter(object):
+
+    def test_routes_master_hosts(self):
+        router = jenkinsBot.GridRouter('example.com')
+        assert router.route(
+            'https://master-foo.example.com/job/bar/1/') == 'foo'
+        assert router.route(
+            'https://MASTER-foo-bar.example.com:8443/job/bar/1/') == 'foo-bar'
+
+    def test_unknown_hosts(self):
+        router = jenkinsBot.GridRouter('example.com')
+        assert router.route('https://jenkins.example.com/job/bar/1/') is None
+        assert router.route('https://master-foo.example.com.evil/job/') is None
+        assert router.route('https://master-fooXexample.com/job/') is None
+
+    def test_learned_hosts(self):
+        router = jenkinsBot.GridRouter('example.com')
+        router.learn('http://10.0.0.1', 'foo')
+        assert router.route('http://10.0.0.1:8080/job/bar/1/') == 'foo'
+
+
+class TestMasterDiscovery(object):
+
+    def test_concurrent_lookups_share_one_discovery(self, instance_api):
+        discovery = jenkinsBot.MasterDiscovery(
+            lambda grid: jenkinsBot.query_instance_api(instance_api['url']))
+        results = []
+
+        def command():
+            results.append(discovery.resolve('foo', wait=5))
+        threads = [threading.Thread(target=command) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        discovery.shutdown()
+
+        assert instance_api['hits'] == 1
+        assert results == ['http://10.0.0.1'] * 10
+
+    def test_starting_master_replies_fast(self, instance_api):
+        instance_api['stdout'] = ['starting']
+        discovery = jenkinsBot.MasterDiscovery(
+            lambda grid: jenkinsBot.query_instance_api(instance_api['url']),
+            deadline=1)
+        started = time.time()
+        with pytest.raises(jenkinsBot.MasterUnavailable) as e:
+            discovery.resolve('foo', wait=0.1)
+        discovery.shutdown()
+
+        assert time.time() - started < 1
+        assert 'still starting' in str(e.value)
+
+    def test_unpublished_masters_do_not_delay_others(self):
+        def fetch(grid):
+            return 'http://10.0.0.1' if grid == 'healthy' else None
+        discovery = jenkinsBot.MasterDiscovery(fetch, deadline=5,
+                                               backoff=(0.5, 0.5), workers=2)
+        for grid in ('down1', 'down2', 'down3', 'down4'):
+            with pytest.raises(jenkinsBot.MasterUnavailable):
+                discovery.resolve(grid, wait=0.05)
+        started = time.time()
+        assert discovery.resolve('healthy', wait=1) == 'http://10.0.0.1'
+        assert time.time() - started < 0.5
+        discovery.shutdown()
+
+
+class TestWorkQueue(object):
+
+    def test_drops_when_full(self):
+        queue = jenkinsBot.WorkQueue(lambda item: None, logging.getLogger(), 2)
+        assert queue.put(1) and queue.put(2)
+        assert not queue.put(3)
+        stats = queue.snapshot()
+        assert stats['received'] == 2
+        assert stats['dropped'] == 1
+        assert stats['queued'] == 2
+
+    def test_workers_drain_queue(self):
+        done = []
+        queue = jenkinsBot.WorkQueue(done.append, logging.getLogger(), 10)
+        queue.start(2)
+        for item in range(5):
+            queue.put(item)
+        queue.queue.join()
+        queue.stop()
+        assert sorted(done) == [0, 1, 2, 3, 4]
+        assert queue.snapshot()['processed'] == 5
+
+
+class TestNotificationCoalescer(object):
+
+    @staticmethod
+    def notification(phase):
+        return {'name': 'foo', 'build': {'number': 1, 'phase': phase}}
+
+    def test_merges_phases_of_a_build(self):
+        flushed = []
+        coalescer = jenkinsBot.NotificationCoalescer(flushed.append, 0.1)
+        coalescer.add('foo#1', self.notification('QUEUED'))
+        coalescer.add('foo#1', self.notification('STARTED'))
+        assert flushed == []
+        time.sleep(0.3)
+        assert flushed == [self.notification('STARTED')]
+        assert coalescer.merged == 1
+
+    def test_keeps_latest_phase(self):
+        flushed = []
+        coalescer = jenkinsBot.NotificationCoalescer(flushed.append, 0.1)
+        coalescer.add('foo#1', self.notification('COMPLETED'))
+        coalescer.add('foo#1', self.notification('STARTED'))
+        time.sleep(0.3)
+        assert flushed == [self.notification('COMPLETED')]
+
+    def test_flushes_finalized_right_away(self):
+        flushed = []
+        coalescer = jenkinsBot.NotificationCoalescer(flushed.append, 10)
+        coalescer.add('foo#1', self.notification('COMPLETED'))
+        coalescer.add('foo#1', self.notification('FINALIZED'))
+        assert flushed == [self.notification('FINALIZED')]
+
+
+class TestOutbox(object):
+
+    class Executor(object):
+
+        def __init__(self):
+            self.submitted = []
+
+        def submit(self, func, *args):
+            self.submitted.append((func, args))
+
+    def test_token_bucket_limits_rate(self):
+        bucket = jenkinsBot.TokenBucket(10, 2)
+        assert bucket.take() == 0
+        assert bucket.take() == 0
+        assert 0 < bucket.take() <= 0.1
+
+    def test_batches_pending_messages(self):
+        delivered = []
+        executor = self.Executor()
+        outbox = jenkinsBot.Outbox(lambda room, batch: delivered.append(
+            (room, batch)), executor, logging.getLogger(), 1, 1)
+        for message in ('a', 'b', 'c'):
+            outbox.put('#ops', message)
+        assert len(executor.submitted) == 1
+        outbox.drain('#ops')
+        assert delivered == [('#ops', ['a', 'b', 'c'])]
+        assert outbox.count() == 0
+        outbox.put('#ops', 'd')
+        assert len(executor.submitted) == 2
+
+    def test_waits_for_a_token(self):
+        delivered = []
+        outbox = jenkinsBot.Outbox(lambda room, batch: delivered.append(
+            batch), self.Executor(), logging.getLogger(), 20, 1, 2)
+        for message in ('a', 'b', 'c'):
+            outbox.put('#ops', message)
+        outbox.drain('#ops')
+        outbox.put('#ops', 'd')
+        start = time.time()
+        outbox.drain('#ops')
+        assert time.time() - start >= 0.04
+        assert delivered == [['a', 'b'], ['c'], ['d']]
+
+
+class TestMetrics(object):
+
+    def test_percentiles(self):
+        metrics = jenkinsBot.Metrics()
+        for ms in range(1, 101):
+            metrics.observe('jenkins.build_job', ms / 1000)
+        stats = metrics.snapshot()['jenkins.build_job']
+        assert stats['count'] == 100
+        assert stats['errors'] == 0
+        assert (stats['p50'], stats['p95'], stats['p99']) == (0.051, 0.096, 0.1)
+
+    def test_timed_counts_errors(self):
+        metrics = jenkinsBot.Metrics()
+        with metrics.timed('broadcast'):
+            pass
+        with pytest.raises(ValueError):
+            with metrics.timed('broadcast'):
+                raise ValueError()
+        stats = metrics.snapshot()['broadcast']
+        assert (stats['count'], stats['errors']) == (2, 1)
+
+    def test_keeps_latest_samples(self):
+        metrics = jenkinsBot.Metrics(samples=2)
+        for seconds in (10, 1, 2):
+            metrics.observe('broadcast', seconds)
+        stats = metrics.snapshot()['broadcast']
+        assert (stats['count'], stats['sum'], stats['p99']) == (3, 13, 2)
+
+    def test_prometheus(self):
+        metrics = jenkinsBot.Metrics()
+        metrics.observe('jenkins.build_job', 0.5)
+        text = metrics.prometheus({'discovery.retries': 3},
+                                  {'chat.waiting': 1})
+        assert ('jenkinsbot_operation_seconds{operation="jenkins.build_job",'
+                'quantile="0.99"} 0.5\n') in text
+        assert ('jenkinsbot_operation_seconds_count'
+                '{operation="jenkins.build_job"} 1\n') in text
+        assert 'jenkinsbot_discovery_retries_total 3\n' in text
+        assert '# TYPE jenkinsbot_chat_waiting gauge\njenkinsbot_chat_waiting 1\n' in text
+
+    def test_instrumented_client(self):
+        class Client(object):
+            server = 'http://jenkins.example.com'
+
+            def _build_url(self, path):
+                return self.server + '/' + path
+
+            def get_version(self):
+                return '2.0'
+
+        metrics = jenkinsBot.Metrics()
+        client = jenkinsBot.InstrumentedJenkins(Client(), metrics)
+        assert client._build_url('job/foo') == \
+            'http://jenkins.example.com/job/foo'
+        assert client.server == 'http://jenkins.example.com'
+        assert client.get_version() == '2.0'
+        assert list(metrics.snapshot()) == ['jenkins.get_version']
+
+
+    def test_instrumented_client_reports_to_breaker(self):
+        class Client(object):
+            def get_version(self):
+                raise requests.ConnectionError()
+
+            def get_job_info(self, name):
+                raise NotFoundException()
+
+        breaker = jenkinsBot.CircuitBreaker(threshold=2)
+        client = jenkinsBot.InstrumentedJenkins(
+            Client(), jenkinsBot.Metrics(), breaker)
+        with pytest.raises(requests.ConnectionError):
+            client.get_version()
+        with pytest.raises(NotFoundException):
+            client.get_job_info('foo')
+        assert breaker.failures == 0
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                client.get_version()
+        assert breaker.state == breaker.OPEN
+        with pytest.raises(jenkinsBot.GridDown):
+            client.get_job_info('foo')
+
+    def test_wrapped_server_errors_are_failures(self):
+        def http_error(status):
+            response = requests.Response()
+            response.status_code = status
+            return requests.HTTPError(response=response)
+
+        def wrapped(status):
+            try:
+                raise http_error(status)
+            except requests.HTTPError:
+                try:
+                    raise JenkinsException('Error in request')
+                except JenkinsException as e:
+                    return e
+
+        assert jenkinsBot.master_failed(wrapped(500))
+        assert jenkinsBot.master_failed(http_error(503))
+        assert not jenkinsBot.master_failed(wrapped(404))
+        assert not jenkinsBot.master_failed(JenkinsException('no such job'))
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_after_threshold(self):
+        breaker = jenkinsBot.CircuitBreaker(threshold=3, cooldown=30)
+        breaker.failure()
+        breaker.failure()
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == breaker.OPEN
+        assert not breaker.allow()
+        assert 29 < breaker.retry_in() <= 30
+        assert breaker.trips == 1
+
+    def test_success_resets_failures(self):
+        breaker = jenkinsBot.CircuitBreaker(threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        assert breaker.state == breaker.CLOSED
+
+    def test_half_open_probe(self):
+        breaker = jenkinsBot.CircuitBreaker(cooldown=0)
+        breaker.trip()
+        assert breaker.allow()
+        assert breaker.state == breaker.HALF_OPEN
+        breaker.failure()
+        assert breaker.state == breaker.OPEN
+        assert breaker.trips == 2
+        assert breaker.allow()
+        breaker.success()
+        assert breaker.state == breaker.CLOSED
+        assert breaker.retry_in() == 0
+
+    def test_single_probe_while_half_open(self):
+        breaker = jenkinsBot.CircuitBreaker(cooldown=30)
+        breaker.trip()
+        assert breaker.refusing()
+        breaker.changed_at -= 30
+        assert not breaker.refusing()
+        assert breaker.allow()
+        assert breaker.refusing()
+        assert not breaker.allow()
+        breaker.probe_at -= 30
+        assert breaker.allow()
+
+    def test_refusing_does_not_take_probe(self):
+        breaker = jenkinsBot.CircuitBreaker('foo', cooldown=0)
+        breaker.trip()
+        assert not breaker.refusing()
+        assert not breaker.refusing()
+        assert breaker.allow()
+        assert 'foo master is unreachable' in str(breaker.refused())
+
+
+class TestLRUCache(object):
+
+    def test_evicts_least_recently_used(self):
+        cache = jenkinsBot.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+
+class TestConsoleStreaming(object):
+
+    def test_streams_before_log_is_complete(self, console_server):
+        started = time.time()
+        response = jenkinsBot.open_console(
+            Jenkins(console_server['url']), 'foo', 1)
+        stream = io.BufferedReader(
+            jenkinsBot.IterStream(jenkinsBot.iter_console(response)),
+            jenkinsBot.CONSOLE_CHUNK_SIZE)
+        first = stream.read(1024)
+        time_to_first_byte = time.time() - started
+        rest = stream.read()
+
+        assert time_to_first_byte < console_server['delay']
+        assert first + rest == console_server['head'] + console_server['tail']
+        assert console_server['starts'] == ['0']
+
+
+class TestConsoleTail(object):
+
+    def test_tail_reads_end_of_log(self, log_server):
+        lines = jenkinsBot.tail_console(Jenkins(log_server['url']), 'foo', 1, 5)
+        assert lines == ['line 995', 'line 996', 'line 997', 'line 998',
+                         'line 999']
+        size = len(log_server['log'])
+        assert log_server['starts'] == [
+            0, size - 5 * jenkinsBot.TAIL_LINE_BYTES]
+
+    def test_tail_of_short_log(self, log_server):
+        log_server['log'] = b'only line\n'
+        lines = jenkinsBot.tail_console(Jenkins(log_server['url']), 'foo', 1, 5)
+        assert lines == ['only line']
+
+    def test_tail_no_lines(self, log_server):
+        assert jenkinsBot.tail_console(
+            Jenkins(log_server['url']), 'foo', 1, 0) == []
+        assert log_server['starts'] == []
+
+    def test_read_console_from_offset(self, log_server):
+        log_server['running'] = True
+        text, size, running = jenkinsBot.read_console(
+            Jenkins(log_server['url']), 'foo', 1, len(log_server['log']) - 9)
+        assert text == b'line 999\n'
+        assert size == len(log_server['log'])
+        assert running
+
+
+class TestQueueSnapshot(object):
+
+    def setup_method(self):
+        self.snapshot = jenkinsBot.QueueSnapshot.from_tree({'items': [
+            {'id': 3, 'inQueueSince': 30, 'task': {'name': 'deploy-db'}},
+            {'id': 1, 'inQueueSince': 10, 'task': {'name': 'Deploy-API'}},
+            {'id': 2, 'inQueueSince': 20, 'task': {'name': 'frontend'}}]})
+
+    def test_items_in_queue_order(self):
+        assert [item['id'] for item in self.snapshot.items] == [1, 2, 3]
+        assert self.snapshot.by_id[2]['task']['name'] == 'frontend'
+
+    def test_find_by_name_ignores_case(self):
+        assert [item['id'] for item in self.snapshot.find('deploy-api')] == [1]
+        assert self.snapshot.find('deploy') == []
+
+    def test_find_by_pattern(self):
+        assert [item['id'] for item in self.snapshot.find('DEPLOY-*')] == [1, 3]
+
+    def test_without(self):
+        snapshot = self.snapshot.without({1, 3})
+        assert [item['id'] for item in snapshot.items] == [2]
+        assert snapshot.find('deploy-api') == []
+
+
+class TestNodeInventory(object):
+
+    def setup_method(self):
+        self.inventory = jenkinsBot.NodeInventory.from_tree({'computer': [
+            {'displayName': 'master', 'offline': False, 'idle': True,
+             'numExecutors': 2, 'assignedLabels': [{'name': 'master'}]},
+            {'displayName': 'runner-foo', 'offline': False, 'idle': False,
+             'numExecutors': 4,
+             'assignedLabels': [{'name': 'linux'}, {'name': 'docker'},
+                                {'name': 'runner-foo'}]},
+            {'displayName': 'runner-bar', 'offline': True, 'idle': True,
+             'numExecutors': 4,
+             'assignedLabels': [{'name': 'linux'}, {'name': 'runner-bar'}]}]})
+
+    def names(self, nodes):
+        return [node['name'] for node in nodes]
+
+    def test_find(self):
+        assert self.names(self.inventory.find()) == [
+            'master', 'runner-bar', 'runner-foo']
+        assert self.names(self.inventory.find('LINUX')) == [
+            'runner-bar', 'runner-foo']
+        assert self.names(self.inventory.find('runner-f*')) == ['runner-foo']
+        assert self.inventory.find('windows') == []
+
+    def test_updates_in_place(self):
+        self.inventory.update('Runner-Bar', offline=False)
+        self.inventory.remove('runner-foo')
+        self.inventory.put({'name': 'runner-baz', 'offline': True,
+                            'idle': True, 'executors': 2, 'labels': []})
+        nodes = self.inventory.find('runner-*')
+        assert self.names(nodes) == ['runner-bar', 'runner-baz']
+        assert nodes[0]['offline'] is False
+
+    def test_executors(self):
+        summary = self.inventory.executors()
+        assert summary[None] == {'nodes': 3, 'executors': 10,
+                                 'online': 6, 'idle': 2}
+        assert summary['linux'] == {'nodes': 2, 'executors': 8,
+                                    'online': 4, 'idle': 0}
+
+
+class TestBuildTracker(object):
+
+    def test_checks_builds_until_done(self):
+        checks = []
+
+        def check(build):
+            checks.append(build['job'])
+            return len(checks) == 2
+        tracker = jenkinsBot.BuildTracker(check, logging.getLogger(),
+                                          intervals=(0, 0))
+        tracker.track({'job': 'foo'})
+        tracker.poll()
+        assert tracker.builds
+        tracker.poll()
+        assert not tracker.builds
+        assert checks == ['foo', 'foo']
+
+    def test_waits_for_next_check(self):
+        checks = []
+        tracker = jenkinsBot.BuildTracker(checks.append, logging.getLogger(),
+                                          intervals=(60, 60))
+        tracker.track({'job': 'foo'})
+        tracker.poll()
+        assert checks == []
+
+    def test_backs_off(self):
+        tracker = jenkinsBot.BuildTracker(lambda build: False,
+                                          logging.getLogger(),
+                                          intervals=(0.01, 0.02))
+        tracker.track({'job': 'foo'})
+        time.sleep(0.02)
+        tracker.poll()
+        assert tracker.builds[0]['interval'] == 0.015
+        time.sleep(0.02)
+        tracker.poll()
+        assert tracker.builds[0]['interval'] == 0.02
+
+
+class TestJobCatalog(object):
+
+    def setup_method(self):
+        self.catalog = jenkinsBot.JobCatalog.from_tree({'jobs': [
+            {'name': 'Deploy-API', 'fullName': 'Deploy-API',
+             'url': 'http://jenkins.example.com/job/Deploy-API/',
+             'color': 'blue'},
+            {'name': 'infra', 'fullName': 'infra',
+             'url': 'http://jenkins.example.com/job/infra/',
+             'jobs': [{'name': 'deploy-db', 'fullName': 'infra/deploy-db',
+                       'url': 'http://jenkins.example.com/job/infra/job/deploy-db/',
+                       'color': 'red'}]}]})
+
+    def test_get_ignores_case(self):
+        job = self.catalog.get('deploy-api')
+        assert job['url'] == 'http://jenkins.example.com/job/Deploy-API/'
+        assert self.catalog.get('deploy') is None
+
+    def test_search_nested_jobs(self):
+        jobs = self.catalog.search('DEPLOY')
+        assert [job['fullname'] for job in jobs] == ['Deploy-API',
+                                                     'infra/deploy-db']
+
+    def test_search_short_term(self):
+        jobs = self.catalog.search('db')
+        assert [job['fullname'] for job in jobs] == ['infra/deploy-db']
+
+    def test_search_no_match(self):
+        assert self.catalog.search('frontend') == []
+
+    def test_flatten_reports_deeper_folders(self, monkeypatch):
+        monkeypatch.setattr(jenkinsBot, 'CATALOG_DEPTH', 1)
+        jobs, folders = jenkinsBot.JobCatalog.flatten({'jobs': [
+            {'name': 'Deploy-API', 'fullName': 'Deploy-API'},
+            {'name': 'infra', 'fullName': 'infra',
+             'jobs': [{'name': 'deploy-db'}]},
+            {'name': 'empty', 'fullName': 'empty', 'jobs': []}]})
+        assert sorted(job['fullname'] for job in jobs) == [
+            'Deploy-API', 'empty', 'infra']
+        assert folders == ['infra']
+
+    def test_match(self):
+        jobs = self.catalog.match('*/DEPLOY-*')
+        assert [job['fullname'] for job in jobs] == ['infra/deploy-db']
+        jobs = self.catalog.match('deploy-?pi')
+        assert [job['fullname'] for job in jobs] == ['Deploy-API']
+
+    def test_prefix(self):
+        jobs = self.catalog.prefix('infra')
+        assert [job['fullname'] for job in jobs] == ['infra',
+                                                     'infra/deploy-db']
+
+
+class TestTemplates(object):
+
+    def teardown_method(self):
+        jenkinsBot.use_template_directory(None)
+
+    def test_template_directory_overrides_defaults(self, tmp_path):
+        (tmp_path / 'params.txt').write_text(
+            '{% for p in params %}{{p.name}} {% endfor %}')
+        jenkinsBot.use_template_directory(str(tmp_path))
+        params = [{'name': 'FOO'}, {'name': 'BAR'}]
+        assert jenkinsBot.JenkinsBot.format_params(params) == 'FOO BAR '
+        assert jenkinsBot.JenkinsBot.format_notification(
+            {'name': 'foo', 'build': {'number': 1, 'phase': 'STARTED',
+                                      'full_url': 'http://jenkins/1/'}},
+            False).startswith('Build #1 STARTED')
+
+    def test_template_directory_hot_reload(self, tmp_path):
+        template = tmp_path / 'params.txt'
+        template.write_text('before')
+        jenkinsBot.use_template_directory(str(tmp_path))
+        assert jenkinsBot.JenkinsBot.format_params([{'name': 'FOO'}]) == 'before'
+
+        template.write_text('after')
+        mtime = os.path.getmtime(str(template)) + 10
+        os.utime(str(template), (mtime, mtime))
+        assert jenkinsBot.JenkinsBot.format_params([{'name': 'FOO'}]) == 'after'
+
+
 class TestJenkinsBotStaticMethods(object):
 
     def test_format_jobs_helper(self):
@@ -76,6 +1207,56 @@ class TestJenkinsBotStaticMethods(object):
         result = jenkinsBot.JenkinsBot.format_jobs(jobs)
         assert result == 'No jobs found.'
 
+    def test_format_running_jobs_helper(self):
+        jobs = [{'name': 'foo',
+                 'color': 'blue_anime',
+                 'lastBuild': {'number': 2,
+                               'url': 'http://jenkins.example.com/job/foo/2/'},
+                 'healthReport': [{'description': 'Build stability: ok'}]},
+                {'name': 'bar', 'color': 'notbuilt_anime',
+                 'lastBuild': None, 'healthReport': []}]
+        result = jenkinsBot.JenkinsBot.format_running_jobs(jobs)
+        assert result == """foo (http://jenkins.example.com/job/foo/2/)
+Build stability: ok
+
+bar ()"""
+
+    def test_format_running_jobs_helper_no_jobs(self):
+        result = jenkinsBot.JenkinsBot.format_running_jobs([])
+        assert result == 'No running jobs.'
+
+    def test_format_nodes_helper(self):
+        nodes = [{'name': 'master', 'offline': False},
+                 {'name': 'runner-foo', 'offline': True}]
+        result = jenkinsBot.JenkinsBot.format_nodes(nodes)
+        assert result == """master     (online)
+runner-foo (offline)"""
+
+    def test_format_nodes_helper_inventory(self):
+        nodes = [{'name': 'master', 'offline': False, 'idle': True,
+                  'executors': 2, 'labels': []},
+                 {'name': 'runner-foo', 'offline': False, 'idle': False,
+                  'executors': 4, 'labels': ['docker', 'linux']}]
+        result = jenkinsBot.JenkinsBot.format_nodes(nodes)
+        assert result == """master     (online, idle, 2 executors)
+runner-foo (online, busy, 4 executors) docker linux"""
+
+    def test_format_executors_helper(self):
+        summary = jenkinsBot.OrderedDict([
+            (None, {'nodes': 3, 'executors': 10, 'online': 6, 'idle': 2}),
+            ('linux', {'nodes': 2, 'executors': 8, 'online': 4, 'idle': 0})])
+        result = jenkinsBot.JenkinsBot.format_executors(summary)
+        assert result == """all nodes 10 executors on 3 nodes, 6 online, 2 idle
+linux     8 executors on 2 nodes, 4 online, 0 idle"""
+
+    def test_format_nodes_helper_no_nodes(self):
+        result = jenkinsBot.JenkinsBot.format_nodes([])
+        assert result == 'No nodes found.'
+
+    def test_format_queue_helper_empty(self):
+        result = jenkinsBot.JenkinsBot.format_queue([])
+        assert result == 'The queue is empty.'
+
     def test_format_params_helper(self):
         params = [{
             'defaultParameterValue': {'value': 'bar'},
@@ -101,6 +1282,92 @@ Parameter Name: FOO
         result = jenkinsBot.JenkinsBot.build_parameters(params)
         assert result == {'': ''}
 
+    def test_parameter_definitions_helper(self):
+        definitions = [{'name': 'FOO', 'type': 'StringParameterDefinition'}]
+        job = {'property': [{}, {'parameterDefinitions': definitions}],
+               'actions': [{}]}
+        assert jenkinsBot.parameter_definitions(job) == definitions
+        job = {'actions': [{}, {'parameterDefinitions': definitions}]}
+        assert jenkinsBot.parameter_definitions(job) == definitions
+        assert jenkinsBot.parameter_definitions({'actions': [{}, {}]}) == []
+
+    def test_check_parameters_helper(self):
+        definitions = [{'name': 'FOO', 'type': 'StringParameterDefinition'},
+                       {'name': 'ENV', 'type': 'ChoiceParameterDefinition',
+                        'choices': ['staging', 'production']}]
+        assert jenkinsBot.check_parameters(
+            definitions, {'FOO': 'bar', 'ENV': 'staging'}) == []
+        assert jenkinsBot.check_parameters(definitions, {'': ''}) == []
+        assert jenkinsBot.check_parameters(
+            definitions, {'BAR': 'baz', 'ENV': 'dev'}) == [
+                'unknown parameter BAR',
+                'ENV should be one of staging, production']
+
+    def test_git_metadata_helper(self):
+        actions = [{}, {'causes': []}, {
+            'lastBuiltRevision': {
+                'SHA1': '0e51ed0c',
+                'branch': [{'name': 'origin/master'}]},
+            'remoteUrls': ['ssh://git@devgit/team_api.git']}]
+        result = jenkinsBot.git_metadata(actions)
+        assert result == {
+            'commit': '0e51ed0c',
+            'branch': 'origin/master',
+            'url': 'https://devgit.cloudpassage.com/team/api.git'}
+
+    def test_repository_name_helper(self):
+        assert jenkinsBot.repository_name('git@github.com:foo/bar.git') == 'bar'
+        assert jenkinsBot.repository_name('https://github.com/foo/tig.git') == 'tig'
+        assert jenkinsBot.repository_name('https://github.com/foo/bar/') == 'bar'
+
+    def test_render_job_config_helper(self):
+        result = jenkinsBot.render_job_config('multibranch',
+                                              'git@github.com:foo/bar.git')
+        assert '<repoOwner>foo</repoOwner>' in result
+        assert '<repository>bar</repository>' in result
+        with pytest.raises(ValueError):
+            jenkinsBot.render_job_config('freestyle', 'git@github.com:foo/bar.git')
+
+    def test_load_manifest_helper(self):
+        jobs = jenkinsBot.load_manifest(json.dumps({
+            'type': 'multibranch',
+            'jobs': ['git@github.com:foo/api.git',
+                     {'name': 'web', 'type': 'pipeline',
+                      'repository': 'git@github.com:foo/frontend.git'}]}))
+        assert jobs == [
+            {'name': 'api', 'type': 'multibranch',
+             'repository': 'git@github.com:foo/api.git'},
+            {'name': 'web', 'type': 'pipeline',
+             'repository': 'git@github.com:foo/frontend.git'}]
+
+    def test_load_manifest_helper_errors(self):
+        for manifest in ('[{"name": "api"}]', '{}',
+                         '["git@github.com:foo/api.git", '
+                         '"git@github.com:bar/api.git"]'):
+            with pytest.raises(ValueError):
+                jenkinsBot.load_manifest(manifest)
+
+    def test_same_config_helper(self):
+        assert jenkinsBot.same_config(
+            "<?xml version='1.1' encoding='UTF-8'?>\n"
+            '<project plugin="workflow-job@2.40">\n  <a>1</a>\n</project>',
+            '<project plugin="workflow-job"><a>1</a></project>')
+        assert not jenkinsBot.same_config('<project><a>1</a></project>',
+                                          '<project><a>2</a></project>')
+
+    def test_set_git_branch_helper(self):
+        result = jenkinsBot.set_git_branch(JOB_CONFIG.format('master'),
+                                           'release')
+        assert '<name>release</name>' in result
+        assert jenkinsBot.set_git_branch(result, 'release') is None
+
+    def test_set_git_branch_helper_no_git(self):
+        with pytest.raises(ValueError):
+            jenkinsBot.set_git_branch('<project/>', 'release')
+
+    def test_git_metadata_helper_no_git(self):
+        assert jenkinsBot.git_metadata([{}, {'causes': []}]) == {}
+
     def test_format_notification(self):
         body = {
             "name": "dummy",
@@ -123,3 +1390,32 @@ Parameter Name: FOO
 (http://jenkins.example.com/job/dummy/1/)
 Based on https://github.com/Djiit/err-jenkins.git/commit/0e51ed \
 (origin/master)"""
+
+    def test_format_stats(self):
+        operations = {'jenkins.build_job': {
+            'count': 3, 'errors': 1, 'sum': 0.3,
+            'p50': 0.05, 'p95': 0.12, 'p99': 0.2}}
+        result = jenkinsBot.JenkinsBot.format_stats(
+            operations, {'discovery.retries': 2}, {'chat.waiting': 0})
+        assert result == """jenkins.build_job 3 calls, 1 errors, \
+p50 50ms, p95 120ms, p99 200ms
+chat.waiting: 0, discovery.retries: 2"""
+
+    def test_format_stats_breakers(self):
+        down = jenkinsBot.CircuitBreaker(cooldown=30)
+        down.trip()
+        result = jenkinsBot.JenkinsBot.format_stats(
+            {}, {}, {}, [('bar', jenkinsBot.CircuitBreaker()), ('foo', down)])
+        assert result.splitlines()[-1] in (
+            'Grids: bar closed, foo open (retry in 29s)',
+            'Grids: bar closed, foo open (retry in 30s)')
+
+    def test_format_digest(self):
+        card = {'title': '0e51ed', 'body': 'SUCCESS COMPLETED dummy #1',
+                'link': 'https://github.com/Djiit/err-jenkins.git/commit/0e51ed',
+                'color': 'green'}
+        result = jenkinsBot.JenkinsBot.format_digest(
+            [(card, True), ('Build #2 FAILURE for Job dummy\n', False)])
+        assert result == """2 notifications:
+SUCCESS COMPLETED dummy #1 https://github.com/Djiit/err-jenkins.git/commit/0e51ed
+Build #2 FAILURE for Job dummy"""